@@ -0,0 +1,524 @@
+import argparse
+import base64
+import gzip
+import hashlib
+import json
+import os
+import random
+import resource
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import main
+
+# End-to-end ingest benchmark: synthetic LoRa traffic goes through read_serial_chunks -> serial_buffer ->
+# identify_data_frame -> dispatch_frame -> CloudEndpoint, which uploads to a local stand-in endpoint.
+#
+#   python bench.py --sensors 200 --rate 500 --duration 30 --transport pty --latency 0.2 --error-rate 0.05
+#   python bench.py --compare-formats --records 50000
+
+sensor_types = ['LoRaTH', 'LoRaTHA', 'LoRaTHO']
+
+payload_struct = struct.Struct('>12sfffH')
+
+
+def percentile(values, p):
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class SyntheticFleet:
+    def __init__(self, size, corrupt_rate=0.01, partial_rate=0.01, noise_rate=0.005, seed=None, duplicate_rate=0.):
+        self.random = random.Random(seed)
+        self.corrupt_rate = corrupt_rate
+        self.partial_rate = partial_rate
+        self.noise_rate = noise_rate
+        # Fraction of frames sent twice, like a LoRa retransmission
+        self.duplicate_rate = duplicate_rate
+        self.last_line = None
+        self.duplicated = 0
+        self.sensors = list()
+        for i in range(size):
+            raw_id = bytes(self.random.getrandbits(8) for _ in range(12))
+            sid = base64.b32encode(raw_id).decode('utf-8').replace('=', '0')
+            self.sensors.append((raw_id, sid, sensor_types[i % len(sensor_types)]))
+        self.generated = 0
+        self.corrupted = 0
+
+    def frame(self):
+        if self.last_line is not None and self.random.random() < self.duplicate_rate:
+            self.duplicated += 1
+            line, self.last_line = self.last_line, None
+            return line
+        raw_id, sid, stype = self.random.choice(self.sensors)
+        temperature = self.random.uniform(15, 30)
+        humidity = self.random.uniform(20, 80)
+        if stype == 'LoRaTHA':
+            extension = self.random.uniform(0, 60)
+        elif stype == 'LoRaTHO':
+            extension = -1. if self.random.random() < 0.2 else 0.
+        else:
+            extension = 0.
+        payload = payload_struct.pack(raw_id, temperature, humidity, extension, self.random.randint(2800, 3300))
+        signal = bytes([self.random.randint(150, 220), self.random.randint(0, 20), self.random.randint(150, 220)])
+        line = (signal + payload + bytes([sum(payload) % 256])).hex().upper().encode()
+        self.generated += 1
+
+        roll = self.random.random()
+        if roll < self.corrupt_rate:
+            self.corrupted += 1
+            i = self.random.randrange(len(line))
+            line = line[:i] + b'0123456789ABCDEF'[self.random.randrange(16):][:1] + line[i + 1:]
+        elif roll < self.corrupt_rate + self.partial_rate:
+            self.corrupted += 1
+            line = line[:self.random.randrange(len(line))]
+        elif roll < self.corrupt_rate + self.partial_rate + self.noise_rate:
+            self.corrupted += 1
+            line = bytes(self.random.getrandbits(8) for _ in range(self.random.randrange(1, 40))) + line
+        self.last_line = line + b'\r\n'
+        return line + b'\r\n'
+
+
+class InjectedReader:
+    # Stands in for serial.Serial: in_waiting/read() over bytes written by the traffic generator
+    def __init__(self, timeout=0.05):
+        self.timeout = timeout
+        self.buffer = bytearray()
+        self.condition = threading.Condition()
+
+    @property
+    def in_waiting(self):
+        return len(self.buffer)
+
+    def write(self, data):
+        with self.condition:
+            self.buffer += data
+            self.condition.notify()
+
+    def read(self, size=1):
+        with self.condition:
+            if not self.buffer:
+                self.condition.wait(self.timeout)
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+
+
+class StandInEndpoint:
+    def __init__(self, fleet, latency=0., error_rate=0., report_interval=0, compact=True):
+        self.latency = latency
+        self.error_rate = error_rate
+        # Whether compact uploads are understood; an older endpoint answers them with 415
+        self.compact = compact
+        self.types = {sid: stype for raw_id, sid, stype in fleet.sensors}
+        self.report_interval = report_interval
+        self.records = 0
+        self.requests = 0
+        self.lookups = 0
+        self.not_modified = 0
+        self.errors = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def info(self, sid):
+        stype = self.types.get(sid, 'LoRaTH')
+        return {'sensor-id': sid, 'sensor-name': stype[4:] + '-' + sid[0:5], 'sensor-type': stype,
+                'report-interval': self.report_interval}
+
+    def received(self, records, sensor_id):
+        with self.lock:
+            self.records += len(records)
+
+    def handler(self):
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def reply(self, status, data=None):
+                body = json.dumps(data).encode('utf-8') if data is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def body(self):
+                data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with endpoint.lock:
+                    endpoint.bytes += len(data)
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    data = gzip.decompress(data)
+                if self.headers.get('Content-Type') == main.compact_content_type:
+                    if not endpoint.compact:
+                        return None
+                    data = main.decode_compact(data)
+                    if 'data' in self.path.split('?')[0].strip('/').split('/')[1:]:
+                        # Per-sensor route: one sensor, shaped like the JSON body
+                        data['records'] = data['sensors'].popitem()[1]
+                    return data
+                return json.loads(data) if data else None
+
+            def simulate(self):
+                with endpoint.lock:
+                    endpoint.requests += 1
+                if endpoint.latency:
+                    time.sleep(endpoint.latency)
+                if random.random() < endpoint.error_rate:
+                    with endpoint.lock:
+                        endpoint.errors += 1
+                    self.reply(503)
+                    return False
+                return True
+
+            def conditional(self, data):
+                # Info replies carry an ETag and answer a matching If-None-Match with 304
+                etag = '"{0}"'.format(hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()[:16])
+                with endpoint.lock:
+                    endpoint.lookups += 1
+                if self.headers.get('If-None-Match') == etag:
+                    with endpoint.lock:
+                        endpoint.not_modified += 1
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if not self.simulate():
+                    return
+                path, _, query = self.path.partition('?')
+                parts = path.strip('/').split('/')
+                if len(parts) == 2 and parts[1] == 'info':
+                    self.conditional(endpoint.info(parts[0]))
+                elif parts == ['info']:
+                    sids = urllib.parse.parse_qs(query).get('sensor-ids', [''])[0].split(',')
+                    self.conditional({sid: endpoint.info(sid) for sid in sids if sid in endpoint.types})
+                else:
+                    self.reply(404)
+
+            def do_PUT(self):
+                self.body()
+                if self.simulate():
+                    self.reply(200, {})
+
+            def do_POST(self):
+                data = self.body()
+                if not self.simulate():
+                    return
+                if data is None and self.headers.get('Content-Type') == main.compact_content_type:
+                    self.reply(415)
+                    return
+                parts = self.path.split('?')[0].strip('/').split('/')
+                if parts == ['']:
+                    self.reply(201, {})
+                elif parts == ['data']:
+                    for sid, records in data['sensors'].items():
+                        endpoint.received(records, sid)
+                    self.reply(200, {sid: endpoint.info(sid) for sid in data['sensors']})
+                elif len(parts) == 2 and parts[1] == 'data':
+                    endpoint.received(data['records'], parts[0])
+                    self.reply(200, endpoint.info(parts[0]))
+                else:
+                    self.reply(404)
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StageTimer:
+    # Wraps main's pipeline functions to time each stage of every frame
+    def __init__(self):
+        self.serial_to_frame = list()
+        self.frame_to_submit = list()
+        self.submit_to_ack = list()
+        self.current_chunk = 0.
+        self.dispatch_started = None
+        self.submit_count = 0
+        # (sensor id, record timestamp) to the time it was first submitted
+        self.submitted = dict()
+        self.lock = threading.Lock()
+
+    def install(self, endpoint):
+        timer = self
+        get = main.serial_buffer.get
+
+        def timed_get(*args, **kwargs):
+            item = get(*args, **kwargs)
+            timer.current_chunk = item[2]
+            return item
+        main.serial_buffer.get = timed_get
+
+        dispatch_frame = main.dispatch_frame
+
+        def timed_dispatch(timestamp, fields, decoded=None):
+            started = time.monotonic()
+            timer.serial_to_frame.append(started - timer.current_chunk)
+            timer.dispatch_started = started
+            dispatch_frame(timestamp, fields, decoded)
+            # Windows flushed between frames are not submitted for a frame
+            timer.dispatch_started = None
+        main.dispatch_frame = timed_dispatch
+
+        submit = main.CloudEndpoint.submit
+
+        def timed_submit(pusher, sensor_id, timestamp, layout, values):
+            now = time.monotonic()
+            if timer.dispatch_started is not None:
+                timer.frame_to_submit.append(now - timer.dispatch_started)
+            timer.submit_count += 1
+            with timer.lock:
+                timer.submitted.setdefault((sensor_id, timestamp), now)
+            submit(pusher, sensor_id, timestamp, layout, values)
+        main.CloudEndpoint.submit = timed_submit
+
+        received = endpoint.received
+
+        def timed_received(records, sensor_id):
+            now = time.monotonic()
+            received(records, sensor_id)
+            with timer.lock:
+                for record in records:
+                    submitted = timer.submitted.get((sensor_id, record['timestamp']))
+                    if submitted is not None:
+                        timer.submit_to_ack.append(now - submitted)
+        endpoint.received = timed_received
+
+
+def main_benchmark(args):
+    fleet = SyntheticFleet(args.sensors, args.corrupt_rate, args.partial_rate, args.noise_rate, args.seed, args.duplicate_rate)
+    endpoint = StandInEndpoint(fleet, args.latency, args.error_rate, args.report_interval, not args.legacy_endpoint)
+    endpoint.start()
+    timer = StageTimer()
+    timer.install(endpoint)
+
+    # Spool and config of the run, removed when it ends
+    workdir = tempfile.TemporaryDirectory(prefix='hub-bench-')
+    main.config_store = main.ConfigStore(os.path.join(workdir.name, 'config.json'))
+    main.endpoint = endpoint.url
+    main.key = 'bench'
+    main.aggregation = args.aggregation
+    main.deduplicator = main.FrameDeduplicator(args.duplicate_window) if args.duplicate_window > 0 else None
+    main.pusher = main.CloudEndpoint(endpoint.url, main.key, interval=args.push_interval,
+                                     spool_file=os.path.join(workdir.name, 'spool.db'),
+                                     upload_mode=args.upload_mode, upload_format=args.upload_format)
+    for raw_id, sid, stype in fleet.sensors:
+        main.sensors[sid] = main.make_sensor(stype, sid, stype[4:] + '-' + sid[0:5], args.report_interval, main.pusher)
+
+    if args.transport == 'pty':
+        master, slave = os.openpty()
+        port = os.ttyname(slave)
+        write = lambda data: os.write(master, data)
+        reader_thread = threading.Thread(target=main.collect_sensor_data, args=(port, 19200))
+    else:
+        reader = InjectedReader()
+        write = reader.write
+        reader_thread = threading.Thread(target=main.read_serial_chunks, args=(reader,))
+
+    threads = [
+        reader_thread,
+        threading.Thread(target=main.identify_data_frame),
+    ]
+    main.pusher.start()
+    main.discovery.start()
+    # Cold start: look the whole fleet up before traffic starts, once
+    prefetch_started = time.monotonic()
+    main.config_sync.start(0)
+    main.config_sync.thread.join()
+    prefetch_seconds = time.monotonic() - prefetch_started
+    for thread in threads:
+        thread.start()
+
+    depths = {'serial_buffer': list(), 'staged': list(), 'spool': list()}
+
+    def sample():
+        while not main.stop_signal.is_set():
+            depths['serial_buffer'].append(main.serial_buffer.qsize())
+            depths['staged'].append(sum(len(buffer) for buffer in list(main.pusher.submission_buffers.values())))
+            depths['spool'].append(main.pusher.queued)
+            main.stop_signal.wait(0.1)
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+
+    if args.trace_memory:
+        tracemalloc.start()
+    started = time.monotonic()
+    deadline = started + args.duration
+    tick = 0.01
+    sent = 0
+    while time.monotonic() < deadline:
+        due = int((time.monotonic() - started) * args.rate)
+        if due > sent:
+            write(b''.join(fleet.frame() for _ in range(due - sent)))
+            sent = due
+        time.sleep(tick)
+    ingest_elapsed = time.monotonic() - started
+
+    # Let the pipeline drain what is already in flight before stopping
+    drain_deadline = time.monotonic() + args.drain
+    while time.monotonic() < drain_deadline and (main.serial_buffer.qsize() or main.pusher.queued):
+        time.sleep(0.1)
+    elapsed = time.monotonic() - started
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+
+    main.stop_signal.set()
+    main.serial_buffer.put((0, b'', time.monotonic(), time.time()))
+    for thread in threads + [sampler, main.pusher.submission_thread, main.pusher.spool_thread, main.discovery.thread]:
+        if thread is not None:
+            thread.join()
+    endpoint.stop()
+    main.pusher.spool.close()
+    workdir.cleanup()
+
+    report = {
+        'sensors': args.sensors,
+        'transport': args.transport,
+        'offered_rate': args.rate,
+        'ingest_seconds': round(ingest_elapsed, 3),
+        'total_seconds': round(elapsed, 3),
+        'frames_generated': fleet.generated,
+        'frames_corrupted': fleet.corrupted,
+        'frames_processed': main.statistic['processed_frames'],
+        'frames_rejected': main.statistic['bad_frames'],
+        'frames_duplicated': fleet.duplicated,
+        'frames_suppressed': main.statistic['duplicate_frames'],
+        'throughput_fps': round(main.statistic['processed_frames'] / ingest_elapsed, 1),
+        'records_submitted': timer.submit_count,
+        'records_acked': endpoint.records,
+        'upload_requests': endpoint.requests,
+        'upload_errors': endpoint.errors,
+        'upload_bytes': endpoint.bytes,
+        'info_lookups': endpoint.lookups,
+        'prefetch_seconds': round(prefetch_seconds, 3),
+        'latency_ms': {},
+        'queue_depth': {name: {'max': max(values, default=0), 'mean': round(sum(values) / len(values), 1) if values else 0}
+                        for name, values in depths.items()},
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if traced_peak is not None:
+        report['traced_peak_kb'] = traced_peak // 1024
+    for name, values in (('serial_to_frame', timer.serial_to_frame),
+                         ('frame_to_submit', timer.frame_to_submit),
+                         ('submit_to_ack', timer.submit_to_ack)):
+        report['latency_ms'][name] = {'p{0}'.format(p): round(percentile(values, p) * 1000, 3) for p in (50, 90, 99)}
+        report['latency_ms'][name]['max'] = round(max(values, default=0.) * 1000, 3)
+    return report
+
+
+def compare_formats(args):
+    # Payload size and encode/decode speed of one bulk upload in each format, for the same fleet traffic
+    fleet = SyntheticFleet(args.sensors, 0., 0., 0., args.seed)
+
+    class Collector:
+        def __init__(self):
+            self.buffers = dict()
+
+        def submit(self, sensor_id, timestamp, layout, values):
+            if sensor_id not in self.buffers:
+                self.buffers[sensor_id] = main.SubmissionBuffer(layout)
+            self.buffers[sensor_id].append(timestamp, values)
+
+    collector = Collector()
+    sensors = {sid: main.make_sensor(stype, sid, sid, args.report_interval, collector) for raw_id, sid, stype in fleet.sensors}
+    timestamp = time.time()
+    for _ in range(args.records):
+        timestamp += 1. / args.rate
+        for frame in main.decode_frames(bytes.fromhex(fleet.frame().strip().decode())):
+            sensors[frame[3]].receive(timestamp, *frame)
+    for sensor in sensors.values():
+        sensor.close_window(float('inf'))
+    batches = {sensor_id: [buffer] for sensor_id, buffer in collector.buffers.items()}
+    records = sum(len(buffer) for buffer in collector.buffers.values())
+
+    report = {'records': records, 'aggregation': args.aggregation}
+    encoders = {
+        'json': (lambda: ('{"key":"bench","sensors":{' + ','.join(json.dumps(sid) + ':' + main.CloudEndpoint.format_records(buffers)
+                                                                  for sid, buffers in batches.items()) + '}}').encode('utf-8'),
+                 json.loads),
+        'compact': (lambda: main.encode_compact('bench', batches), main.decode_compact),
+    }
+    for name, (encode, decode) in encoders.items():
+        started = time.perf_counter()
+        body = encode()
+        encoded = time.perf_counter()
+        decode(body)
+        decoded = time.perf_counter()
+        report[name] = {'bytes': len(body), 'gzip_bytes': len(gzip.compress(body)),
+                        'bytes_per_record': round(len(body) / max(records, 1), 1),
+                        'encode_records_per_s': round(records / (encoded - started)),
+                        'decode_records_per_s': round(records / (decoded - encoded))}
+    return report
+
+
+def print_report(report):
+    for name, value in report.items():
+        if isinstance(value, dict):
+            print('{0}:'.format(name))
+            for stage, stats in value.items():
+                print('  {0:<16} {1}'.format(stage, '  '.join('{0}={1}'.format(k, v) for k, v in stats.items())
+                                              if isinstance(stats, dict) else stats))
+        else:
+            print('{0}: {1}'.format(name, value))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='End-to-end ingest benchmark for the sensor hub')
+    arg_parser.add_argument('--sensors', type=int, default=50, help='fleet size')
+    arg_parser.add_argument('--rate', type=float, default=200., help='frames per second offered to the serial side')
+    arg_parser.add_argument('--duration', type=float, default=10., help='seconds of traffic')
+    arg_parser.add_argument('--drain', type=float, default=30., help='seconds allowed to drain the pipeline afterwards')
+    arg_parser.add_argument('--transport', choices=['inject', 'pty'], default='inject')
+    arg_parser.add_argument('--corrupt-rate', type=float, default=0.01, help='fraction of lines with a flipped character')
+    arg_parser.add_argument('--partial-rate', type=float, default=0.01, help='fraction of truncated lines')
+    arg_parser.add_argument('--noise-rate', type=float, default=0.005, help='fraction of lines with leading noise')
+    arg_parser.add_argument('--duplicate-rate', type=float, default=0., help='fraction of lines sent twice')
+    arg_parser.add_argument('--duplicate-window', type=float, default=2., help='deduplication window; 0 disables it')
+    arg_parser.add_argument('--latency', type=float, default=0., help='seconds the endpoint waits before answering')
+    arg_parser.add_argument('--error-rate', type=float, default=0., help='fraction of endpoint requests answered with 503')
+    arg_parser.add_argument('--report-interval', type=int, default=0, help='sensor report interval; 0 submits every reading')
+    arg_parser.add_argument('--aggregation', choices=['throttle', 'window'], default='throttle')
+    arg_parser.add_argument('--push-interval', type=float, default=1.)
+    arg_parser.add_argument('--upload-mode', choices=['bulk', 'per-sensor'], default='bulk')
+    arg_parser.add_argument('--upload-format', choices=['json', 'compact'], default='json')
+    arg_parser.add_argument('--legacy-endpoint', action='store_true', help='endpoint answers compact uploads with 415')
+    arg_parser.add_argument('--compare-formats', action='store_true',
+                            help='only compare upload formats on --records frames of fleet traffic, without the pipeline')
+    arg_parser.add_argument('--records', type=int, default=20000, help='frames generated for --compare-formats')
+    arg_parser.add_argument('--trace-memory', action='store_true', help='also report the tracemalloc peak (slower)')
+    arg_parser.add_argument('--seed', type=int, default=None)
+    arg_parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = arg_parser.parse_args()
+
+    if args.compare_formats:
+        main.aggregation = args.aggregation
+        report = compare_formats(args)
+    else:
+        report = main_benchmark(args)
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print_report(report)
@@ -1,6 +1,6 @@
 import contextlib
 import math
-from typing import Dict, List, Set, Union
+from typing import Dict, List, Set
 import serial
 import os
 import traceback
@@ -9,13 +9,27 @@ import time
 import json
 import decimal
 import base64
+import array
+import bisect
 import threading
 import requests
 import random
 import queue
+import collections
+import http.server
+import itertools
+import argparse
+import gzip
+import concurrent.futures
+import sqlite3
 import logging
 from datetime import datetime, timedelta
-import npyscreen
+import signal
+import socket
+import mmap
+import urllib.parse
+import multiprocessing
+from multiprocessing import shared_memory
 
 version = '4.3'
 
@@ -42,278 +56,1223 @@ class ConnectivityStatusIndicator:
         self.endpoint = endpoint
         self.interval = interval
 
+class BoundedQueue(queue.Queue):
+    # queue.Queue with a capacity and a policy for a full queue: 'block' waits for room (until the hub stops),
+    # 'drop-oldest' discards the oldest item, 'drop-newest' discards the item being added.
+    # Keeps the high-water mark and the number of items dropped.
+    policies = ('block', 'drop-oldest', 'drop-newest')
+
+    def __init__(self, maxsize=0, policy='block'):
+        if policy not in self.policies:
+            raise ValueError('Unknown queue policy {0}'.format(policy))
+        super().__init__(maxsize)
+        self.policy = policy
+        self.high_water = 0
+        self.dropped = 0
+
+    def _put(self, item):
+        super()._put(item)
+        if len(self.queue) > self.high_water:
+            self.high_water = len(self.queue)
+
+    def offer(self, item) -> bool:
+        # Adds item according to the policy; False if it was dropped instead
+        while True:
+            try:
+                if self.policy == 'block' and not stop_signal.is_set():
+                    self.put(item, timeout=1)
+                else:
+                    self.put_nowait(item)
+                return True
+            except queue.Full:
+                if self.policy == 'block' and not stop_signal.is_set():
+                    continue
+                if self.policy == 'drop-oldest':
+                    try:
+                        self.get_nowait()
+                    except queue.Empty:
+                        continue
+                with self.mutex:
+                    self.dropped += 1
+                if self.policy != 'drop-oldest':
+                    return False
+
+
+class RecordLayout:
+    # Field names, array typecodes and decimal precision (None if unknown) of one record shape,
+    # and the template its records are serialised to JSON with
+    __slots__ = ('fields', 'typecodes', 'decimals', 'template')
+
+    def __init__(self, fields, typecodes, decimals):
+        self.fields = tuple(fields)
+        self.typecodes = tuple(typecodes)
+        self.decimals = tuple(decimals)
+        self.template = '{{"timestamp":{},"value":{{' + \
+                        ','.join(json.dumps(field).replace('{', '{{').replace('}', '}}') + ':{}' for field in self.fields) + '}}}}'
+
+
+record_layouts = dict()
+
+def record_layout(fields, typecodes, decimals) -> RecordLayout:
+    # Layouts are shared, so staging buffers can be told apart by identity
+    key = (tuple(fields), tuple(typecodes), tuple(decimals))
+    if key not in record_layouts:
+        record_layouts[key] = RecordLayout(*key)
+    return record_layouts[key]
+
+
+class SubmissionBuffer:
+    # Append-only staging columns of one sensor: timestamps plus one typed array per field of the layout.
+    # Records are never materialised as dicts; serialise() formats the rows straight into JSON text.
+    # Records dropped from the front are only skipped (start) until they are half of the arrays, so a
+    # saturated staging buffer drops its oldest record in amortised constant time.
+    __slots__ = ('layout', 'timestamps', 'columns', 'start')
+
+    def __init__(self, layout: RecordLayout):
+        self.layout = layout
+        self.timestamps = array.array('d')
+        self.columns = [array.array(typecode) for typecode in layout.typecodes]
+        self.start = 0
+
+    def __len__(self):
+        return len(self.timestamps) - self.start
+
+    def append(self, timestamp, values):
+        self.timestamps.append(timestamp)
+        for column, value in zip(self.columns, values):
+            column.append(value)
+
+    def drop_first(self):
+        self.start += 1
+        if self.start * 2 >= len(self.timestamps):
+            self.compact()
+
+    def compact(self):
+        # Removes the dropped records; everything reading the arrays directly calls this first
+        if self.start:
+            del self.timestamps[:self.start]
+            for column in self.columns:
+                del column[:self.start]
+            self.start = 0
+
+    def replace_last(self, timestamp, values):
+        self.timestamps[-1] = timestamp
+        for column, value in zip(self.columns, values):
+            column[-1] = value
+
+    def tobytes(self) -> bytes:
+        self.compact()
+        return b''.join([self.timestamps.tobytes()] + [column.tobytes() for column in self.columns])
+
+    @classmethod
+    def frombytes(cls, layout: RecordLayout, size: int, data: bytes):
+        buffer = cls(layout)
+        offset = 0
+        for column in [buffer.timestamps] + buffer.columns:
+            end = offset + size * column.itemsize
+            column.frombytes(data[offset:end])
+            offset = end
+        return buffer
+
+    def serialise(self) -> str:
+        # Comma separated record objects, ready to be placed inside a JSON array.
+        # Timestamps are whole seconds, written as JSON integers like they always were
+        self.compact()
+        rows = zip(map(int, self.timestamps), *self.columns)
+        if all(all(map(math.isfinite, column)) for column in self.columns if column.typecode in 'fd'):
+            return ','.join(itertools.starmap(self.layout.template.format, rows))
+        # NaN and infinity have no JSON literal of their own, leave them to json
+        return ','.join(json.dumps({'timestamp': row[0], 'value': dict(zip(self.layout.fields, row[1:]))}, separators=(',', ':'))
+                        for row in rows)
+
+
+def buffers_from_records(records) -> List[SubmissionBuffer]:
+    # (timestamp, readings dict) pairs, as spooled by older versions, into buffers of consecutive records with the same fields
+    buffers = list()
+    run = list()
+    for timestamp, readings in records + [(None, None)]:
+        if run and (readings is None or readings.keys() != run[0][1].keys()):
+            fields = list(run[0][1])
+            typecodes = ['q' if all(type(r[field]) is int for t, r in run) else 'd' for field in fields]
+            buffer = SubmissionBuffer(record_layout(fields, typecodes, [None] * len(fields)))
+            for t, r in run:
+                buffer.append(t, [r[field] for field in fields])
+            buffers.append(buffer)
+            run = list()
+        run.append((timestamp, readings))
+    return buffers
+
+
+# Compact upload format, sent as compact_content_type. All integers are zigzag LEB128 varints.
+#   b'HUB1', key (length + UTF-8), number of sensors
+#   per sensor: id (length + UTF-8), number of blocks; a block is a run of records with one layout
+#   per block: number of records, number of fields, then per field its name (length + UTF-8),
+#       encoding and decimals
+#   timestamps in milliseconds, the first one as is and each following one as the difference to the previous
+#   per field one column: encoding 0 is value * 10 ** decimals rounded, differenced like the timestamps;
+#       encoding 1 is raw little-endian float64, for columns with NaN/infinity or without a known precision
+# decode_compact() is the reference decoder.
+compact_content_type = 'application/x-hub-columns'
+
+
+def write_varints(out: bytearray, values):
+    for value in values:
+        value = value << 1 if value >= 0 else (-value << 1) - 1
+        while value > 0x7f:
+            out.append(value & 0x7f | 0x80)
+            value >>= 7
+        out.append(value)
+
+
+def write_deltas(out: bytearray, values: List[int]):
+    write_varints(out, values[:1])
+    write_varints(out, map(int.__sub__, values[1:], values))
+
+
+def write_string(out: bytearray, string: str):
+    data = string.encode('utf-8')
+    write_varints(out, (len(data),))
+    out += data
+
+
+def encode_compact(key: str, batches: Dict[str, List[SubmissionBuffer]]) -> bytes:
+    out = bytearray(b'HUB1')
+    write_string(out, key)
+    write_varints(out, (len(batches),))
+    for sensor_id, buffers in batches.items():
+        write_string(out, sensor_id)
+        buffers = [buffer for buffer in buffers if buffer]
+        write_varints(out, (len(buffers),))
+        for buffer in buffers:
+            buffer.compact()
+            layout = buffer.layout
+            write_varints(out, (len(buffer), len(layout.fields)))
+            encodings = list()
+            for field, decimals, column in zip(layout.fields, layout.decimals, buffer.columns):
+                if column.typecode not in 'fd':
+                    encodings.append((0, decimals or 0))
+                elif decimals is not None and all(map(math.isfinite, column)):
+                    encodings.append((0, decimals))
+                else:
+                    encodings.append((1, 0))
+                write_string(out, field)
+                write_varints(out, encodings[-1])
+            write_deltas(out, [round(timestamp * 1000) for timestamp in buffer.timestamps])
+            for (encoding, decimals), column in zip(encodings, buffer.columns):
+                if encoding == 0:
+                    scale = 10 ** decimals
+                    write_deltas(out, [round(value * scale) for value in column] if decimals else [round(value) for value in column])
+                else:
+                    out += struct.pack('<{0}d'.format(len(column)), *column)
+    return bytes(out)
+
+
+def decode_compact(data: bytes) -> dict:
+    # Returns the same structure as a JSON bulk upload: {'key': ..., 'sensors': {sensor id: [records]}}
+    offset = 4
+    if data[:offset] != b'HUB1':
+        raise ValueError('Not a compact upload')
+
+    def varints(count):
+        nonlocal offset
+        values = list()
+        for _ in range(count):
+            value = shift = 0
+            while True:
+                byte = data[offset]
+                offset += 1
+                value |= (byte & 0x7f) << shift
+                shift += 7
+                if byte < 0x80:
+                    break
+            values.append(value >> 1 if not value & 1 else -(value >> 1) - 1)
+        return values
+
+    def deltas(count):
+        return list(itertools.accumulate(varints(count)))
+
+    def string():
+        nonlocal offset
+        length, = varints(1)
+        offset += length
+        return data[offset - length:offset].decode('utf-8')
+
+    key = string()
+    sensors = dict()
+    for _ in range(varints(1)[0]):
+        sensor_id = string()
+        records = sensors.setdefault(sensor_id, list())
+        for _ in range(varints(1)[0]):
+            size, field_count = varints(2)
+            fields = list()
+            for _ in range(field_count):
+                name = string()
+                fields.append((name,) + tuple(varints(2)))
+            # Whole seconds come back as integers, as in a JSON upload
+            timestamps = [timestamp // 1000 if timestamp % 1000 == 0 else timestamp / 1000 for timestamp in deltas(size)]
+            columns = list()
+            for name, encoding, decimals in fields:
+                if encoding == 0:
+                    column = deltas(size)
+                    columns.append([value / 10 ** decimals for value in column] if decimals else column)
+                else:
+                    columns.append(list(struct.unpack_from('<{0}d'.format(size), data, offset)))
+                    offset += size * 8
+            names = [name for name, encoding, decimals in fields]
+            for timestamp, row in zip(timestamps, zip(*columns)):
+                records.append({'timestamp': timestamp, 'value': dict(zip(names, row))})
+    return {'key': key, 'sensors': sensors}
+
+
+class SubmissionSpool:
+    # Durable backlog of readings waiting for upload. Each row is a batch of records for one sensor,
+    # appended every spool interval (one transaction, one fsync) and deleted once the server accepts it.
+    # SQLite in WAL mode keeps the writes sequential and the backlog off the heap while offline.
+    # A batch is kept as the raw columns of a SubmissionBuffer and its layout, and serialised when uploaded.
+    def __init__(self, path='spool.db'):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS batches ('
+                        'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                        'sensor_id TEXT NOT NULL, '
+                        'size INTEGER NOT NULL, '
+                        'records TEXT NOT NULL, '
+                        'layout TEXT, '
+                        'columns BLOB)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS batches_sensor ON batches (sensor_id, id)')
+        # Spools of older versions hold JSON lists of [timestamp, readings] pairs in records
+        existing = [row[1] for row in self.db.execute('PRAGMA table_info(batches)')]
+        for column, column_type in (('layout', 'TEXT'), ('columns', 'BLOB')):
+            if column not in existing:
+                self.db.execute('ALTER TABLE batches ADD COLUMN {0} {1}'.format(column, column_type))
+        self.db.commit()
+
+    def append(self, buffers: List[tuple]):
+        # (sensor id, SubmissionBuffer) pairs
+        rows = [(sensor_id, len(buffer), json.dumps([buffer.layout.fields, buffer.layout.typecodes, buffer.layout.decimals]), buffer.tobytes())
+                for sensor_id, buffer in buffers if buffer]
+        if not rows:
+            return
+        with self.lock, self.db:
+            self.db.executemany("INSERT INTO batches (sensor_id, size, records, layout, columns) VALUES (?, ?, '', ?, ?)", rows)
+
+    def pending(self) -> int:
+        with self.lock:
+            return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM batches').fetchone()[0]
+
+    def pending_by_sensor(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.db.execute('SELECT sensor_id, SUM(size) FROM batches GROUP BY sensor_id'))
+
+    def sensors(self) -> List[str]:
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT DISTINCT sensor_id FROM batches')]
+
+    def fetch(self, sensor_id: str, limit: int):
+        # Oldest batches of a sensor, at least one and as many more as fit in limit records.
+        # Returns the batch ids and a SubmissionBuffer per batch
+        ids = list()
+        buffers = list()
+        count = 0
+        with self.lock:
+            cursor = self.db.execute('SELECT id, size, records, layout, columns FROM batches WHERE sensor_id = ? ORDER BY id',
+                                     (sensor_id,))
+            for batch_id, size, records, layout, columns in cursor:
+                if ids and count + size > limit:
+                    break
+                ids.append(batch_id)
+                count += size
+                if columns is not None:
+                    buffers.append(SubmissionBuffer.frombytes(record_layout(*json.loads(layout)), size, columns))
+                else:
+                    buffers.extend(buffers_from_records(json.loads(records)))
+            cursor.close()
+        return ids, buffers
+
+    def trim(self, capacity: int):
+        # Deletes the oldest batches while more than capacity records are pending (0 is unlimited).
+        # Returns the records pending before trimming and the records deleted
+        with self.lock, self.db:
+            pending = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM batches').fetchone()[0]
+            if not capacity or pending <= capacity:
+                return pending, 0
+            ids = list()
+            dropped = 0
+            for batch_id, size in self.db.execute('SELECT id, size FROM batches ORDER BY id'):
+                if pending - dropped <= capacity:
+                    break
+                ids.append(batch_id)
+                dropped += size
+            self.db.executemany('DELETE FROM batches WHERE id = ?', [(batch_id,) for batch_id in ids])
+        return pending, dropped
+
+    def acknowledge(self, ids: List[int]):
+        if not ids:
+            return
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM batches WHERE id = ?', [(batch_id,) for batch_id in ids])
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class CircuitBreaker:
+    # Tracks consecutive failures of one upload target. The first max_failures failures are retried
+    # every cycle; after that the breaker opens and the next attempt waits an exponentially growing,
+    # jittered delay. One success closes it again.
+    def __init__(self, max_failures=3, base_delay=10., max_delay=900.):
+        self.max_failures = max_failures
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = 0
+        self.retry_at = 0.
+
+    @property
+    def open(self):
+        return self.failures >= self.max_failures
+
+    def allow(self, now):
+        return now >= self.retry_at
+
+    def success(self):
+        self.failures = 0
+        self.retry_at = 0.
+
+    def failure(self, now):
+        self.failures += 1
+        if self.open:
+            delay = min(self.max_delay, self.base_delay * 2 ** (self.failures - self.max_failures))
+            self.retry_at = now + delay / 2 + random.uniform(0, delay / 2)
+
+
 class CloudEndpoint():
-    def __init__(self, endpoint, key, interval=10):
+    def __init__(self, endpoint, key, interval=10, spool_file='spool.db', upload_workers=4, request_timeout=(5, 30),
+                 upload_mode='per-sensor', compress=False, upload_batch_size=500, retry_policy=None, upload_format='json',
+                 staging_capacity=50000, staging_policy='drop-oldest', spool_capacity=2000000, spool_interval=1):
         self.endpoint = endpoint
         self.key = key
         self.push_interval = interval
-        self.submission_queues = dict()
+        # Upper bound on records per sensor per upload attempt
+        self.upload_batch_size = upload_batch_size
+        self.retry_policy = retry_policy or dict()
+        self.endpoint_breaker = CircuitBreaker(**self.retry_policy)
+        self.sensor_breakers = dict()
+        self.upload_workers = upload_workers
+        # (connect, read) timeout in seconds for every request to the endpoint
+        self.request_timeout = request_timeout
+        self.compress = compress
+        # 'json' or 'compact'; drops back to 'json' for good if the endpoint rejects compact uploads
+        self.upload_format = upload_format
+        self.bulk_upload = upload_mode == 'bulk'
+        # A requests.Session is not meant to be shared between threads: every upload worker (and the push
+        # thread, for bulk uploads) keeps its own keep-alive session across cycles, closed when pushing stops
+        self.local = threading.local()
+        self.sessions = list()
+        self.sessions_lock = threading.Lock()
+        # Readings submitted since they were last spooled, a SubmissionBuffer per (sensor id, layout),
+        # moved to the spool every spool_interval seconds and at the start of each push cycle. A crash loses
+        # at most spool_interval seconds of readings, at the cost of an fsync per interval (0 spools only per cycle)
+        self.spool_interval = spool_interval
+        self.spool_lock = threading.Lock()
+        self.submission_buffers = dict()
         self.queue_lock = threading.Lock()
+        # Bound on staged records if push cycles stall. When full, 'block' makes submit() wait for the next cycle,
+        # 'drop-oldest' drops the sensor's oldest staged record, 'keep-latest' overwrites the sensor's last one
+        if staging_policy not in ('block', 'drop-oldest', 'keep-latest'):
+            raise ValueError('Unknown staging policy {0}'.format(staging_policy))
+        self.staging_capacity = staging_capacity
+        self.staging_policy = staging_policy
+        self.staging_room = threading.Condition(self.queue_lock)
+        self.staged = 0
+        self.staging_high_water = 0
+        self.staging_dropped = 0
+        # Bound on spooled records; beyond it the oldest batches are deleted (0 is unlimited)
+        self.spool_capacity = spool_capacity
+        self.spool_high_water = 0
+        self.spool_dropped = 0
+        self.spool = SubmissionSpool(spool_file)
         self.submission_thread = None
+        self.spool_thread = None
         self.running = threading.Event()
-        self.queued = 0
+        # Records left over from the last run are uploaded from the spool like any other backlog
+        self.queued = self.spool.pending()
         self.pushed = 0
 
-    def submit(self, sensor_id, timestamp, readings):
-        self.queue_lock.acquire()
-        if sensor_id not in self.submission_queues:
-            self.submission_queues[sensor_id] = queue.PriorityQueue()
-        
-        self.submission_queues[sensor_id].put((timestamp, readings))
-        self.queue_lock.release()
-        self.queued += 1
-        current_status[3] = 'Queued/Pushed: {0}/{1}'.format(self.queued, self.pushed)
+    def submit(self, sensor_id, timestamp, layout, values):
+        # Readings of one serial stream arrive in time order, so appending keeps each buffer sorted
+        with self.queue_lock:
+            while self.staging_policy == 'block' and self.staged >= self.staging_capacity and not stop_signal.is_set():
+                self.staging_room.wait(1)
+            buffer = self.submission_buffers.get((sensor_id, layout))
+            if buffer is None:
+                buffer = self.submission_buffers[(sensor_id, layout)] = SubmissionBuffer(layout)
+            if self.staged >= self.staging_capacity and buffer and self.staging_policy != 'block':
+                self.staging_dropped += 1
+                if self.staging_policy == 'keep-latest':
+                    buffer.replace_last(timestamp, values)
+                    return
+                buffer.drop_first()
+                self.staged -= 1
+                self.queued -= 1
+            buffer.append(timestamp, values)
+            self.staged += 1
+            self.queued += 1
+            if self.staged > self.staging_high_water:
+                self.staging_high_water = self.staged
 
     def start(self):
         self.submission_thread = threading.Thread(target=self.push)
         self.submission_thread.start()
+        if self.spool_interval:
+            self.spool_thread = threading.Thread(target=self.spool_periodically)
+            self.spool_thread.start()
 
-    def push(self):
-        while not stop_signal.is_set():
+    def spool_periodically(self):
+        # Spools what was staged without waiting for the push cycle, which may be stuck on the network
+        while not stop_signal.wait(self.spool_interval):
             try:
-                if self.running.is_set():
-                    return
-                self.running.set()
-                self.queue_lock.acquire()
-                for sensor_id in self.submission_queues:
-                    if self.submission_queues[sensor_id].empty():
-                        continue
-                    records = list()
-                    while not self.submission_queues[sensor_id].empty():
-                        timestamp, readings = self.submission_queues[sensor_id].get()
-                        records.append({'timestamp': timestamp, 'value': readings})
-                    data = {'key': self.key, 'records': records}
-                    try:
-                        response = requests.post(self.endpoint + '/' + sensor_id + '/data', json=data)
-                        if response.ok:
-                            update_data = response.json()
-                            if not update_remote:
-                                sensors[sensor_id].update_config(update_data)
-                            self.queued -= len(records)
-                            self.pushed += len(records)
-                            current_status[3] = 'Queued/Pushed: {0}/{1}'.format(self.queued, self.pushed)
-                            current_status[4] = ''
-                        else:
-                            for record in records:
-                                self.submission_queues[sensor_id].put((record['timestamp'], record['value']))
-                    except:
-                        for record in records:
-                                self.submission_queues[sensor_id].put((record['timestamp'], record['value']))
-                
+                self.spool_staged()
             except Exception as e:
-                logging.exception('[Push]')
-                current_status[4] = 'Internet Connection Lost'
-            finally:
-                self.queue_lock.release()
-                self.running.clear()
-            time.sleep(self.push_interval)
+                logging.exception('[Push] Spool')
+
+    def spool_staged(self):
+        # Only the hand-over from the staging queues holds queue_lock; submit() never waits on the disk.
+        # spool_lock is held from the hand-over to the append, so batches get row ids in the order they
+        # were staged and a sensor's records are uploaded in order, whichever thread spools them
+        with self.spool_lock:
+            with self.queue_lock:
+                staged = self.submission_buffers
+                self.submission_buffers = dict()
+                self.staged = 0
+                self.staging_room.notify_all()
+            self.spool_submissions(staged)
+
+    def spool_submissions(self, submission_buffers):
+        self.spool.append([(sensor_id, buffer) for (sensor_id, layout), buffer in submission_buffers.items()])
+
+    @property
+    def session(self) -> requests.Session:
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+            with self.sessions_lock:
+                self.sessions.append(session)
+        return session
+
+    def close_sessions(self):
+        with self.sessions_lock:
+            sessions, self.sessions = self.sessions, list()
+        for session in sessions:
+            session.close()
+        self.local = threading.local()
+
+    def post(self, url, body: bytes, content_type='application/json'):
+        headers = {'Content-Type': content_type}
+        if self.compress:
+            headers['Content-Encoding'] = 'gzip'
+            response = self.session.post(url, data=gzip.compress(body), headers=headers, timeout=self.request_timeout)
+            if response.status_code not in (requests.codes.bad_request, requests.codes.unsupported_media_type):
+                return response
+            # Retry uncompressed; if that is accepted the endpoint cannot read gzip bodies
+            del headers['Content-Encoding']
+            response = self.session.post(url, data=body, headers=headers, timeout=self.request_timeout)
+            if response.ok:
+                logging.info('[Push] Endpoint does not accept gzip, uploading uncompressed')
+                self.compress = False
+            return response
+        return self.session.post(url, data=body, headers=headers, timeout=self.request_timeout)
+
+    @staticmethod
+    def format_records(buffers):
+        return '[' + ','.join(buffer.serialise() for buffer in buffers if buffer) + ']'
+
+    def send(self, url, batches, sensor_id=None):
+        # batches maps sensor ids to their spooled buffers; with sensor_id the JSON body is the per-sensor one
+        if self.upload_format == 'compact':
+            response = self.post(url, encode_compact(self.key, batches), compact_content_type)
+            if response.status_code not in (requests.codes.bad_request, requests.codes.unsupported_media_type):
+                return response
+            logging.info('[Push] Endpoint does not accept compact uploads, uploading JSON')
+            self.upload_format = 'json'
+        if sensor_id is None:
+            body = '{"key":' + json.dumps(self.key) + ',"sensors":{' + \
+                   ','.join(json.dumps(sid) + ':' + self.format_records(buffers) for sid, buffers in batches.items()) + '}}'
+        else:
+            body = '{"key":' + json.dumps(self.key) + ',"records":' + self.format_records(batches[sensor_id]) + '}'
+        return self.post(url, body.encode('utf-8'))
+
+    def upload(self, sensor_id, buffers):
+        response = self.send(self.endpoint + '/' + sensor_id + '/data', {sensor_id: buffers}, sensor_id)
+        response.raise_for_status()
+        return response.json()
+
+    def upload_bulk(self, batches):
+        # All sensors in one request; the reply maps sensor ids to the same info the per-sensor route returns.
+        # Returns None when the caller should upload per sensor instead: for good if the endpoint has no bulk
+        # route, for this cycle if it refused the request (4xx), so that only the sensors whose batches it
+        # refuses are charged for it. A transport error or 5xx is raised, it is the endpoint's failure.
+        response = self.send(self.endpoint + '/data', {sensor_id: buffers for sensor_id, (ids, buffers) in batches.items()})
+        if response.status_code in (requests.codes.not_found, requests.codes.method_not_allowed, requests.codes.not_implemented):
+            logging.info('[Push] Endpoint has no bulk upload route, uploading per sensor')
+            self.bulk_upload = False
+            return None
+        if 400 <= response.status_code < 500:
+            logging.warning('[Push] Bulk upload refused ({0}), uploading per sensor'.format(response.status_code))
+            return None
+        response.raise_for_status()
+        update_data = response.json()
+        return {sensor_id: update_data.get(sensor_id) for sensor_id in batches}
+
+    def upload_each(self, batches, executor):
+        uploads = {executor.submit(self.upload, sensor_id, buffers): sensor_id for sensor_id, (ids, buffers) in batches.items()}
+        results = dict()
+        for future in concurrent.futures.as_completed(uploads):
+            try:
+                results[uploads[future]] = future.result()
+            except Exception as e:
+                results[uploads[future]] = e
+        return results
+
+    def push(self):
+        if self.running.is_set():
+            return
+        self.running.set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.upload_workers) as executor:
+            while not stop_signal.is_set():
+                backlog = self.push_cycle(executor)
+                # Drain a backlog batch after batch, otherwise wait for the next interval
+                stop_signal.wait(0 if backlog else self.push_interval)
         try:
-            save_config(sensors)
+            self.spool_staged()
+        except Exception as e:
+            logging.exception('[Push] Spool')
+        self.close_sessions()
+        self.running.clear()
+        try:
+            save_config(sensors, immediately=True)
         except Exception as e:
             logging.exception('[Config updating]')
 
+    def push_cycle(self, executor):
+        # Returns True when the cycle made progress and more backlog is waiting in the spool
+        try:
+            self.spool_staged()
+            pending, dropped = self.spool.trim(self.spool_capacity)
+            if pending > self.spool_high_water:
+                self.spool_high_water = pending
+            if dropped:
+                logging.warning('[Push] Spool over capacity, dropped the oldest {0} records'.format(dropped))
+                self.spool_dropped += dropped
+                with self.queue_lock:
+                    self.queued -= dropped
+        except Exception as e:
+            logging.exception('[Push] Spool')
+            return False
+
+        now = time.monotonic()
+        if not self.endpoint_breaker.allow(now):
+            return False
+
+        acknowledged = list()
+        failed = False
+        unreachable = False
+        try:
+            batches = dict()
+            for sensor_id in self.spool.sensors():
+                breaker = self.sensor_breakers.get(sensor_id)
+                if breaker is not None and not breaker.allow(now):
+                    continue
+                batches[sensor_id] = self.spool.fetch(sensor_id, self.upload_batch_size)
+            results = None
+            if batches and self.bulk_upload:
+                try:
+                    results = self.upload_bulk(batches)
+                except Exception as e:
+                    # Not any one sensor's fault, so no sensor breaker is charged
+                    statistic['push_failure'] += 1
+                    logging.warning('[Push] Bulk upload: {0}'.format(e))
+                    self.endpoint_breaker.failure(now)
+                    current_status[4] = 'Internet Connection Lost'
+                    return False
+            if results is None:
+                results = self.upload_each(batches, executor)
+            for sensor_id, update_data in results.items():
+                ids, buffers = batches[sensor_id]
+                if isinstance(update_data, Exception):
+                    statistic['push_failure'] += 1
+                    # The batch stays in the spool as it is and is retried once its breaker allows
+                    logging.warning('[Push] {0}: {1}'.format(sensor_id, update_data))
+                    failed = True
+                    if isinstance(update_data, (requests.ConnectionError, requests.Timeout)):
+                        unreachable = True
+                    else:
+                        self.sensor_breakers.setdefault(sensor_id, CircuitBreaker(**self.retry_policy)).failure(now)
+                    continue
+                acknowledged.extend(ids)
+                statistic['push_success'] += 1
+                acked_at = time.time()
+                count = 0
+                for buffer in buffers:
+                    count += len(buffer)
+                    for timestamp in buffer.timestamps:
+                        metrics.submit_to_ack.observe(acked_at - timestamp)
+                self.sensor_breakers.pop(sensor_id, None)
+                with self.queue_lock:
+                    self.queued -= count
+                self.pushed += count
+                if update_data and not update_remote:
+                    # The upload is done either way: a reply it cannot apply must not keep the batches
+                    # of the other sensors from being acknowledged
+                    try:
+                        config_sync.apply(sensor_id, update_data)
+                    except Exception as e:
+                        logging.exception('[Push] {0}: sensor info'.format(sensor_id))
+            if unreachable:
+                self.endpoint_breaker.failure(now)
+            elif acknowledged:
+                self.endpoint_breaker.success()
+            current_status[4] = 'Internet Connection Lost' if failed and not acknowledged else ''
+        except Exception as e:
+            logging.exception('[Push]')
+            current_status[4] = 'Internet Connection Lost'
+            self.endpoint_breaker.failure(now)
+            failed = True
+        finally:
+            try:
+                self.spool.acknowledge(acknowledged)
+            except Exception as e:
+                logging.exception('[Push] Spool')
+                return False
+        return bool(acknowledged) and not failed and self.spool.pending() > 0
+
+
+# Default anemometer calibration: pulse frequency (Hz) to air velocity (m/s).
+# Readings below the first point are treated as still air, readings above the last one use a linear fit.
+default_airflow_calibration = {
+    'frequency': [
+        3.5, 3.6, 3.7, 3.8, 3.9, 4.0, 4.1, 4.2, 4.3, 4.4, 4.5, 4.6, 4.7, 4.8, 4.9, 5.0, 5.1, 5.2, 5.3, 5.4, 5.5, 5.6,
+        5.7, 5.8, 5.9, 6.0, 6.1, 6.2, 6.3, 6.4, 6.5, 6.6, 6.7, 6.8, 6.9, 7.0, 7.1, 7.2, 7.3, 7.4, 7.5, 7.6, 7.7, 7.8,
+        7.9, 8.0, 8.1, 8.2, 8.3, 8.4, 8.5, 8.6, 8.7, 8.8, 8.9, 9.0, 9.1, 9.2, 9.3, 9.4, 9.5, 9.6, 9.7, 9.8, 9.9, 10.0,
+        10.1, 10.2, 10.3, 10.4, 10.5, 10.6, 10.7, 10.8, 10.9, 11.0, 11.1, 11.2, 11.3, 11.4, 11.5, 11.6, 11.7, 11.8,
+        11.9, 12.0, 12.1, 12.2, 12.3, 12.4, 12.5, 12.6, 12.7, 12.8, 12.9, 13.0, 13.1, 13.2, 13.3, 13.4, 13.5, 13.6,
+        13.7, 13.8, 13.9, 14.0, 14.1, 14.2, 14.3, 14.4, 14.5, 14.6, 14.7, 14.8, 14.9, 15.0, 15.1, 15.2, 15.3, 15.4,
+        15.5, 15.6, 15.7, 15.8, 15.9, 16.0, 16.1, 16.2, 16.3, 16.4, 16.5, 16.6, 16.7, 16.8, 16.9, 17.0, 17.1, 17.2,
+        17.3, 17.4, 17.5, 17.6, 17.7, 17.8, 17.9, 18.0, 18.1, 18.2, 18.3, 18.4, 18.5, 18.6, 18.7, 18.8, 18.9, 19.0,
+        19.1, 19.2, 19.3, 19.4, 19.5, 19.6, 19.7, 19.8, 19.9, 20.0, 22.0, 24.0, 26.0, 28.0, 30.0, 32.0, 34.0, 36.0,
+        38.0, 40.0, 42.0, 44.0, 46.0, 48.0, 50.0, 52.0, 54.0, 56.0, 58.0, 60.0, 62.0, 64.0, 66.0, 68.0, 70.0, 72.0,
+        74.0, 76.0, 78.0, 80.0, 82.0, 84.0, 86.0, 88.0, 90.0, 92.0, 94.0, 96.0, 98.0, 100.0
+    ],
+    'velocity': [
+        0.3, 0.31, 0.31, 0.32, 0.33, 0.34, 0.35, 0.36, 0.37, 0.37, 0.38, 0.39, 0.4, 0.41, 0.42, 0.43, 0.43, 0.44, 0.5,
+        0.51, 0.52, 0.53, 0.54, 0.55, 0.56, 0.57, 0.58, 0.59, 0.6, 0.61, 0.62, 0.62, 0.63, 0.65, 0.66, 0.8, 0.81, 0.82,
+        0.83, 0.84, 0.86, 0.87, 0.88, 0.89, 0.9, 0.91, 0.93, 0.94, 0.95, 0.96, 0.97, 0.98, 0.99, 1, 1.02, 1.03, 1.04,
+        1.05, 1.06, 1.07, 1.09, 1.1, 1.1, 1.12, 1.13, 1.14, 1.15, 1.17, 1.18, 1.19, 1.1, 1.12, 1.12, 1.13, 1.14, 1.15,
+        1.16, 1.17, 1.19, 1.2, 1.21, 1.22, 1.22, 1.23, 1.24, 1.25, 1.27, 1.24, 1.2, 1.21, 1.22, 1.24, 1.25, 1.26, 1.27,
+        1.28, 1.29, 1.3, 1.31, 1.32, 1.33, 1.34, 1.34, 1.35, 1.36, 1.2, 1.21, 1.22, 1.23, 1.24, 1.24, 1.26, 1.27, 1.27,
+        1.29, 1.29, 1.3, 1.31, 1.32, 1.32, 1.33, 1.34, 1.32, 1.3, 1.31, 1.32, 1.33, 1.33, 1.34, 1.35, 1.36, 1.37, 1.38,
+        1.38, 1.39, 1.4, 1.42, 1.42, 1.43, 1.45, 1.4, 1.41, 1.42, 1.43, 1.44, 1.45, 1.46, 1.46, 1.47, 1.47, 1.48, 1.49,
+        1.5, 1.5, 1.51, 1.52, 1.53, 1.43, 1.41, 1.42, 1.42, 1.43, 1.44, 1.45, 1.45, 1.46, 1.57, 1.6, 1.7, 1.81, 1.92,
+        2.04, 2.16, 2.26, 2.4, 2.5, 2.61, 2.72, 2.85, 2.86, 2.97, 3.09, 3.21, 3.32, 3.43, 3.55, 3.66, 3.77, 3.88, 4.01,
+        4.12, 4.22, 4.36, 4.49, 4.58, 4.59, 4.71, 4.83, 4.94, 5.07, 5.17, 5.29, 5.4, 5.53, 5.63, 5.76
+    ],
+    'slope': 0.0532,
+    'intercept': 0.3714
+}
+
+class AirflowCalibration:
+    def __init__(self, frequency, velocity, slope=0., intercept=0.):
+        points = sorted(zip(frequency, velocity))
+        if len(points) < 2:
+            raise ValueError('Airflow calibration needs at least two points')
+        self.frequency = [float(f) for f, _ in points]
+        self.velocity = [float(v) for _, v in points]
+        self.slope = slope
+        self.intercept = intercept
+
+    @classmethod
+    def from_config(cls, conf):
+        return cls(conf['frequency'], conf['velocity'], conf.get('slope', 0.), conf.get('intercept', 0.))
+
+    def convert(self, airflow_freq):
+        frequency = self.frequency
+        if airflow_freq < frequency[0]:
+            return 0.
+        if airflow_freq >= frequency[-1]:
+            if airflow_freq == frequency[-1]:
+                return self.velocity[-1]
+            return self.slope * airflow_freq + self.intercept
+        i = bisect.bisect_right(frequency, airflow_freq)
+        freq_low = frequency[i - 1]
+        velo_low = self.velocity[i - 1]
+        return (self.velocity[i] - velo_low) * (airflow_freq - freq_low) / (frequency[i] - freq_low) + velo_low
+
+    def convert_many(self, frequencies):
+        convert = self.convert
+        return [convert(f) for f in frequencies]
+
+
+# Calibration name to AirflowCalibration, extended by 'airflow_calibrations' in config.json
+airflow_calibrations = {'default': AirflowCalibration.from_config(default_airflow_calibration)}
+
+class SensorTable:
+    # Last reading of every sensor, one typed array per field indexed by Sensor.slot, so thousands
+    # of sensors cost a few dozen bytes each instead of a dict of boxed floats and a display string.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_reading = array.array('d')
+        self.last_push = array.array('d')
+        self.temperature = array.array('f')
+        self.humidity = array.array('f')
+        self.value = array.array('f')
+        self.battery = array.array('H')
+        self.rssi = array.array('B')
+        self.snr = array.array('B')
+        self.columns = (self.last_reading, self.last_push, self.temperature, self.humidity, self.value,
+                        self.battery, self.rssi, self.snr)
+
+    def allocate(self) -> int:
+        with self.lock:
+            for column in self.columns:
+                column.append(0)
+            return len(self.last_reading) - 1
+
+
+sensor_table = SensorTable()
+
+# sensor-type to Sensor subclass, filled by register_sensor_type
+sensor_types = dict()
+
+def register_sensor_type(cls):
+    sensor_types[cls.sensor_type] = cls
+    cls.layout = record_layout(cls.fields, cls.typecodes, cls.decimals)
+    # A window record has mean/min/max of 'mean' fields, the last value of the others and the sample count
+    fields = list()
+    typecodes = list()
+    decimals = list()
+    for field, typecode, places, summary in zip(cls.fields, cls.typecodes, cls.decimals, cls.summaries):
+        if summary == 'mean':
+            fields.extend((field, field + '_min', field + '_max'))
+            typecodes.extend(('d', typecode, typecode))
+            decimals.extend((places,) * 3)
+        else:
+            fields.append(field)
+            typecodes.append(typecode)
+            decimals.append(places)
+    cls.window_layout = record_layout(fields + ['samples'], typecodes + ['I'], decimals + [0])
+    return cls
+
+def make_sensor(stype, sensor_id, sensor_name, report_interval, data_handler, sconf=None, slot=None):
+    cls = sensor_types.get(stype, LoRaTHSensor)
+    return cls(sensor_id, sensor_name, report_interval, data_handler, slot=slot, **cls.options(sconf or dict()))
 
-class LoRaTHSensor:
-    def __init__(self, sensor_id, sensor_name, report_interval, data_handler):
+def sensor_units(sensor) -> Dict[str, str]:
+    unit = {'temperature': 'degC', 'humidity': '%RH'}
+    unit.update(sensor.units)
+    return unit
+
+
+class WindowAggregate:
+    # Running count/min/max/sum/last of each field over one tumbling window
+    __slots__ = ('start', 'latest', 'count', 'minimum', 'maximum', 'total', 'last')
+
+    def __init__(self, start, timestamp, values):
+        self.start = start
+        self.latest = timestamp
+        self.count = 1
+        self.minimum = list(values)
+        self.maximum = list(values)
+        self.total = list(values)
+        self.last = list(values)
+
+    def add(self, timestamp, values):
+        self.latest = timestamp
+        self.count += 1
+        for i, value in enumerate(values):
+            if value < self.minimum[i]:
+                self.minimum[i] = value
+            if value > self.maximum[i]:
+                self.maximum[i] = value
+            self.total[i] += value
+            self.last[i] = value
+
+
+class Sensor:
+    __slots__ = ('sensor_id', 'sensor_name', 'report_interval', 'data_handler', 'pushed_readings', 'slot', 'window')
+
+    sensor_type = None
+    # Reading names and units the type adds to temperature/humidity/battery
+    units = dict()
+    # Submitted reading names, their array typecodes, the decimals the hardware actually resolves,
+    # and how a window summarises each: 'mean' (plus _min/_max) or 'last'
+    fields = ('temperature', 'humidity', 'battery')
+    typecodes = ('d', 'd', 'H')
+    decimals = (2, 2, 0)
+    summaries = ('mean', 'mean', 'last')
+    # Set by register_sensor_type
+    layout = None
+    window_layout = None
+
+    def __init__(self, sensor_id, sensor_name, report_interval, data_handler, slot=None):
         self.sensor_id = sensor_id
         self.sensor_name = sensor_name
-        self.sensor_type = 'LoRaTH'
         self.report_interval = report_interval
         self.data_handler = data_handler
-        self.reading_display = '-'
-        self.last_reading_timestamp = 0
-        self.last_push_timestamp = 0
         self.pushed_readings = 0
+        # A replacement for an existing sensor keeps its slot and with it the last reading
+        self.slot = sensor_table.allocate() if slot is None else slot
+        self.window = None
+
+    @staticmethod
+    def options(sconf):
+        # Type-specific constructor arguments from a config.json sensor entry
+        return dict()
+
+    def carry_over(self, previous):
+        # Takes over what the sensor this one replaces has collected and not submitted yet. An open window
+        # moves across if it summarises the same fields, otherwise it is submitted as it is
+        self.pushed_readings = previous.pushed_readings
+        if previous.window is not None:
+            if previous.window_layout is self.window_layout:
+                self.window = previous.window
+                previous.window = None
+            else:
+                previous.close_window(float('inf'))
+
+    def to_config(self):
+        return {
+            'id': self.sensor_id,
+            'name': self.sensor_name,
+            'type': self.sensor_type,
+            'report-interval': self.report_interval
+        }
+
+    @property
+    def last_reading_timestamp(self):
+        return sensor_table.last_reading[self.slot]
+
+    @property
+    def last_push_timestamp(self):
+        return sensor_table.last_push[self.slot]
+
+    @property
+    def reading_display(self):
+        table = sensor_table
+        slot = self.slot
+        if table.last_reading[slot] == 0:
+            return '-'
+        return self.format_reading(table.temperature[slot], table.humidity[slot], table.value[slot], table.battery[slot] / 1000)
+
+    def format_reading(self, temperature, humidity, value, battery):
+        return '{0:.2f}°C {1:.1f}%RH         {2:.3f}V '.format(temperature, humidity, battery)
+
+    def convert(self, extension):
+        # The frame's third value as this type reports it
+        return 0.
+
+    def values(self, temperature, humidity, value, battery):
+        # Submitted values in the order of fields
+        return temperature, humidity, battery
+
+    def submitted(self):
+        pass
 
     def receive(self, timestamp, rssi, snr, signal_rssi, sid, temperature, humidity, extension, battery, checksum):
-        self.reading_display = '{0:.2f}°C {1:.1f}%RH         {2:.3f}V '.format(temperature, humidity, battery / 1000)
-        self.last_reading_timestamp = timestamp
+        if aggregation == 'window':
+            self.close_window(timestamp)
+        value = self.convert(extension)
+        table = sensor_table
+        slot = self.slot
+        table.last_reading[slot] = timestamp
+        table.temperature[slot] = temperature
+        table.humidity[slot] = humidity
+        table.value[slot] = value
+        table.battery[slot] = battery
+        table.rssi[slot] = rssi
+        table.snr[slot] = snr
+        if history is not None:
+            history.append(self.sensor_id, timestamp, temperature, humidity, value, battery, rssi, snr)
+        if aggregation == 'window':
+            values = self.values(temperature, humidity, value, battery)
+            if self.window is None:
+                start = timestamp - timestamp % self.report_interval if self.report_interval > 0 else timestamp
+                self.window = WindowAggregate(start, timestamp, values)
+            else:
+                self.window.add(timestamp, values)
+            return
         # Discard readings based on report interval
-        if timestamp < self.last_push_timestamp + self.report_interval * 0.8:
+        if timestamp < table.last_push[slot] + self.report_interval * 0.8:
+            return
+        self.data_handler.submit(self.sensor_id, timestamp, self.layout, self.values(temperature, humidity, value, battery))
+        self.submitted()
+        self.pushed_readings += 1
+        table.last_push[slot] = timestamp
+
+    def close_window(self, now):
+        # Submits one summary record for the window once `now` is past its end
+        window = self.window
+        if window is None or now < window.start + self.report_interval:
             return
-        self.data_handler.submit(self.sensor_id, timestamp, {
-            'temperature': temperature,
-            'humidity': humidity,
-            'battery': battery
-        })
+        self.window = None
+        record = list()
+        for i, summary in enumerate(self.summaries):
+            if summary == 'mean':
+                record.extend((window.total[i] / window.count, window.minimum[i], window.maximum[i]))
+            else:
+                record.append(window.last[i])
+        record.append(window.count)
+        self.data_handler.submit(self.sensor_id, window.start, self.window_layout, record)
+        self.submitted()
         self.pushed_readings += 1
-        self.last_push_timestamp = timestamp
+        sensor_table.last_push[self.slot] = window.latest
 
     def update_config(self, update_data):
-        self.sensor_name = update_data['sensor-name']
-        self.report_interval = update_data['report-interval']
-            
-class LoRaTHASensor:
-    def __init__(self, sensor_id, sensor_name, report_interval, data_handler):
-        self.sensor_id = sensor_id
+        sensor_name = update_data['sensor-name']
+        report_interval = update_data['report-interval']
+        if sensor_name == self.sensor_name and report_interval == self.report_interval:
+            return False
         self.sensor_name = sensor_name
-        self.sensor_type = 'LoRaTHA'
         self.report_interval = report_interval
-        self.data_handler = data_handler
-        self.reading_display = '-'
-        self.last_reading_timestamp = 0
-        self.last_push_timestamp = 0
-        self.pushed_readings = 0
+        return True
 
-    airflow_conversion_low = {'3.5': 0.3, '3.6': 0.31, '3.7': 0.31, '3.8': 0.32, '3.9': 0.33, '4.0': 0.34, '4.1': 0.35, '4.2': 0.36, '4.3': 0.37, '4.4': 0.37, 
-    '4.5': 0.38, '4.6': 0.39, '4.7': 0.4, '4.8': 0.41, '4.9': 0.42, '5.0': 0.43, '5.1': 0.43, '5.2': 0.44, '5.3': 0.5, '5.4': 0.51, '5.5': 0.52, '5.6': 0.53, 
-    '5.7': 0.54, '5.8': 0.55, '5.9': 0.56, '6.0': 0.57, '6.1': 0.58, '6.2': 0.59, '6.3': 0.6, '6.4': 0.61, '6.5': 0.62, '6.6': 0.62, '6.7': 0.63, '6.8': 0.65, 
-    '6.9': 0.66, '7.0': 0.8, '7.1': 0.81, '7.2': 0.82, '7.3': 0.83, '7.4': 0.84, '7.5': 0.86, '7.6': 0.87, '7.7': 0.88, '7.8': 0.89, '7.9': 0.9, '8.0': 0.91, 
-    '8.1': 0.93, '8.2': 0.94, '8.3': 0.95, '8.4': 0.96, '8.5': 0.97, '8.6': 0.98, '8.7': 0.99, '8.8': 1, '8.9': 1.02, '9.0': 1.03, '9.1': 1.04, '9.2': 1.05, 
-    '9.3': 1.06, '9.4': 1.07, '9.5': 1.09, '9.6': 1.1, '9.7': 1.1, '9.8': 1.12, '9.9': 1.13, '10.0': 1.14, '10.1': 1.15, '10.2': 1.17, '10.3': 1.18, '10.4': 1.19, 
-    '10.5': 1.1, '10.6': 1.12, '10.7': 1.12, '10.8': 1.13, '10.9': 1.14, '11.0': 1.15, '11.1': 1.16, '11.2': 1.17, '11.3': 1.19, '11.4': 1.2, '11.5': 1.21, 
-    '11.6': 1.22, '11.7': 1.22, '11.8': 1.23, '11.9': 1.24, '12.0': 1.25, '12.1': 1.27, '12.2': 1.24, '12.3': 1.2, '12.4': 1.21, '12.5': 1.22, '12.6': 1.24, 
-    '12.7': 1.25, '12.8': 1.26, '12.9': 1.27, '13.0': 1.28, '13.1': 1.29, '13.2': 1.3, '13.3': 1.31, '13.4': 1.32, '13.5': 1.33, '13.6': 1.34, '13.7': 1.34, 
-    '13.8': 1.35, '13.9': 1.36, '14.0': 1.2, '14.1': 1.21, '14.2': 1.22, '14.3': 1.23, '14.4': 1.24, '14.5': 1.24, '14.6': 1.26, '14.7': 1.27, '14.8': 1.27, 
-    '14.9': 1.29, '15.0': 1.29, '15.1': 1.3, '15.2': 1.31, '15.3': 1.32, '15.4': 1.32, '15.5': 1.33, '15.6': 1.34, '15.7': 1.32, '15.8': 1.3, '15.9': 1.31, 
-    '16.0': 1.32, '16.1': 1.33, '16.2': 1.33, '16.3': 1.34, '16.4': 1.35, '16.5': 1.36, '16.6': 1.37, '16.7': 1.38, '16.8': 1.38, '16.9': 1.39, '17.0': 1.4, 
-    '17.1': 1.42, '17.2': 1.42, '17.3': 1.43, '17.4': 1.45, '17.5': 1.4, '17.6': 1.41, '17.7': 1.42, '17.8': 1.43, '17.9': 1.44, '18.0': 1.45, '18.1': 1.46, 
-    '18.2': 1.46, '18.3': 1.47, '18.4': 1.47, '18.5': 1.48, '18.6': 1.49, '18.7': 1.5, '18.8': 1.5, '18.9': 1.51, '19.0': 1.52, '19.1': 1.53, '19.2': 1.43, 
-    '19.3': 1.41, '19.4': 1.42, '19.5': 1.42, '19.6': 1.43, '19.7': 1.44, '19.8': 1.45, '19.9': 1.45, '20.0': 1.46}
-
-    airflow_conversion_high = {'20': 1.46, '22': 1.57, '24': 1.6, '26': 1.7, '28': 1.81, '30': 1.92, '32': 2.04, '34': 2.16, '36': 2.26, '38': 2.4, '40': 2.5, 
-    '42': 2.61, '44': 2.72, '46': 2.85, '48': 2.86, '50': 2.97, '52': 3.09, '54': 3.21, '56': 3.32, '58': 3.43, '60': 3.55, '62': 3.66, '64': 3.77, '66': 3.88, 
-    '68': 4.01, '70': 4.12, '72': 4.22, '74': 4.36, '76': 4.49, '78': 4.58, '80': 4.59, '82': 4.71, '84': 4.83, '86': 4.94, '88': 5.07, '90': 5.17, '92': 5.29, 
-    '94': 5.4, '96': 5.53, '98': 5.63, '100': 5.76}
-
-    def receive(self, timestamp, rssi, snr, signal_rssi, sid, temperature, humidity, airflow, battery, checksum):
-        airflow = self.convert_airflow(airflow)
-        self.reading_display = '{0:.2f}°C {1:.1f}%RH {2:.2f}m/s {3:.3f}V '.format(temperature, humidity, airflow, battery / 1000)
-        self.last_reading_timestamp = timestamp
-        # Discard readings based on report interval
-        if timestamp < self.last_push_timestamp + self.report_interval * 0.8:
-            return
-        self.data_handler.submit(self.sensor_id, timestamp, {
-            'temperature': temperature,
-            'humidity': humidity,
-            'airflow': airflow,
-            'battery': battery
-        })
-        self.pushed_readings += 1
-        self.last_push_timestamp = timestamp
-        
 
-    def update_config(self, update_data):
-        self.sensor_name = update_data['sensor-name']
-        self.report_interval = update_data['report-interval']
+@register_sensor_type
+class LoRaTHSensor(Sensor):
+    __slots__ = ()
+
+    sensor_type = 'LoRaTH'
+
+
+@register_sensor_type
+class LoRaTHASensor(Sensor):
+    __slots__ = ('calibration_name', 'calibration')
+
+    sensor_type = 'LoRaTHA'
+    units = {'airflow': 'm/s'}
+    fields = ('temperature', 'humidity', 'airflow', 'battery')
+    typecodes = ('d', 'd', 'd', 'H')
+    decimals = (2, 2, 2, 0)
+    summaries = ('mean', 'mean', 'mean', 'last')
+
+    def __init__(self, sensor_id, sensor_name, report_interval, data_handler, slot=None, calibration='default'):
+        super().__init__(sensor_id, sensor_name, report_interval, data_handler, slot)
+        self.calibration_name = calibration
+        self.calibration = airflow_calibrations.get(calibration, airflow_calibrations['default'])
+
+    @staticmethod
+    def options(sconf):
+        return {'calibration': sconf.get('calibration', 'default')}
+
+    def to_config(self):
+        sconf = super().to_config()
+        if self.calibration_name != 'default':
+            sconf['calibration'] = self.calibration_name
+        return sconf
+
+    def format_reading(self, temperature, humidity, value, battery):
+        return '{0:.2f}°C {1:.1f}%RH {2:.2f}m/s {3:.3f}V '.format(temperature, humidity, value, battery)
+
+    def convert(self, extension):
+        return self.calibration.convert(extension)
 
     def convert_airflow(self, airflow_freq):
-        if airflow_freq < 3.5: return 0.
-        if airflow_freq < 20:
-            freq_low = math.floor(airflow_freq * 10) / 10
-            freq_high = freq_low + 0.1
-            freq_str_low = '{0:.1f}'.format(freq_low)
-            freq_str_high = '{0:.1f}'.format(freq_high)
-            velo_low = LoRaTHASensor.airflow_conversion_low[freq_str_low]
-            velo_high = LoRaTHASensor.airflow_conversion_low[freq_str_high]
-            airflow_velo = (velo_high - velo_low) * (airflow_freq - freq_low) / 0.1 + velo_low
-            return airflow_velo
-        if airflow_freq <= 100:
-            freq_low = math.floor(airflow_freq // 2 * 2)
-            freq_high = freq_low + 2
-            freq_str_low = '{0:.0f}'.format(freq_low)
-            freq_str_high = '{0:.0f}'.format(freq_high)
-            velo_low = LoRaTHASensor.airflow_conversion_high[freq_str_low]
-            velo_high = LoRaTHASensor.airflow_conversion_high[freq_str_high]
-            airflow_velo = (velo_high - velo_low) * (airflow_freq - freq_low) / 2 + velo_low
-            return airflow_velo
-        airflow_velo = 0.0532 * airflow_freq + 0.3714
-        return airflow_velo
-        
-
-class LoRaTHOSensor:
-    def __init__(self, sensor_id, sensor_name, report_interval, data_handler):
-        self.sensor_id = sensor_id
-        self.sensor_name = sensor_name
-        self.sensor_type = 'LoRaTHO'
-        self.report_interval = report_interval
-        self.data_handler = data_handler
-        self.pushed_readings = 0
+        return self.calibration.convert(airflow_freq)
+
+    def values(self, temperature, humidity, value, battery):
+        return temperature, humidity, value, battery
+
 
+@register_sensor_type
+class LoRaTHOSensor(Sensor):
+    __slots__ = ('motion_event',)
+
+    sensor_type = 'LoRaTHO'
+    units = {'occupancy': '/min'}
+    # Motion events accumulate until submitted, so the last value is the window's count
+    fields = ('temperature', 'humidity', 'occupancy', 'battery')
+    typecodes = ('d', 'd', 'I', 'H')
+    decimals = (2, 2, 0, 0)
+    summaries = ('mean', 'mean', 'last', 'last')
+
+    def __init__(self, sensor_id, sensor_name, report_interval, data_handler, slot=None):
+        super().__init__(sensor_id, sensor_name, report_interval, data_handler, slot)
         self.motion_event = 0
 
-        self.reading_display = '-'
-        self.last_reading_timestamp = 0
-        self.last_push_timestamp = 0
+    def format_reading(self, temperature, humidity, value, battery):
+        return '{0:.2f}°C {1:.1f}%RH {2} times {3:.3f}V '.format(temperature, humidity, int(value), battery)
 
-    def receive(self, timestamp, rssi, snr, signal_rssi, sid, temperature, humidity, motion, battery, checksum):   
+    def convert(self, motion):
+        # Motion is counted between pushes
         if motion < 0:
-            self.motion_event += 1     
-        self.reading_display = '{0:.2f}°C {1:.1f}%RH {2} times {3:.3f}V '.format(temperature, humidity, self.motion_event, battery / 1000)
-        self.last_reading_timestamp = timestamp
-        # Discard readings based on report interval
-        if timestamp < self.last_push_timestamp + self.report_interval * 0.8:
-            return
-        self.data_handler.submit(self.sensor_id, timestamp, {
-            'temperature': temperature,
-            'humidity': humidity,
-            'occupancy': self.motion_event,
-            'battery': battery
-        })
+            self.motion_event += 1
+        return self.motion_event
+
+    def values(self, temperature, humidity, value, battery):
+        return temperature, humidity, self.motion_event, battery
+
+    def submitted(self):
         self.motion_event = 0
-        self.pushed_readings += 1
-        self.last_push_timestamp = timestamp
 
-    def update_config(self, update_data):
-        self.sensor_name = update_data['sensor-name']
-        self.report_interval = update_data['report-interval']
+    def carry_over(self, previous):
+        super().carry_over(previous)
+        if isinstance(previous, LoRaTHOSensor):
+            self.motion_event = previous.motion_event
+            previous.motion_event = 0
 
 
 
-def handle_dataframe(frame: Union[List[bytes], bytes], timestamp: int):
-    if isinstance(frame, list):
-        frame = b''.join(frame)
-    if debug:
-        log = open('frame_dump.log', 'a')
-        log.write(frame.hex() + '\n')
-        log.close()
-    if len(frame) != 30:
-        statistic['bad_frames'] += 1
-        current_status[2] = 'Rejected: {0}'.format(statistic['bad_frames'])
-        return
-    if sum(frame[3:29]) % 256 == frame[29]:
-        rssi, snr, signalr_rssi, sid = struct.unpack('>BBB12s', frame[0:15])
-        temperature, humidity, airflow, battery, checksum = struct.unpack('>fffHB', frame[15:30])
-        sid = base64.b32encode(sid).decode('utf-8').replace('=', '0')
-        if sid not in sensors or sensors[sid].pushed_readings == 0:
-            handle_unknown_sensor(sid)
-        sensors[sid].receive(timestamp, rssi, snr, signalr_rssi, sid, temperature, humidity, airflow, battery,
-                                   checksum)
-        statistic['processed_frames'] += 1
-        current_status[1] = 'Processed: {0}'.format(statistic['processed_frames'])
-    else:
-        statistic['bad_frames'] += 1
-        current_status[2] = 'Rejected: {0}'.format(statistic['bad_frames'])
+# rssi, snr, signal rssi, sensor id, temperature, humidity, airflow/motion/extension, battery, checksum
+frame_struct = struct.Struct('>BBB12sfffHB')
 
-def pull_remote_sensor_info(response):
-    sensor_info = response.json()
+sensor_id_cache = dict()
+
+def sensor_id_string(raw_id: bytes) -> str:
+    sid = sensor_id_cache.get(raw_id)
+    if sid is None:
+        if len(sensor_id_cache) >= 4096:
+            sensor_id_cache.clear()
+        sid = base64.b32encode(raw_id).decode('utf-8').replace('=', '0')
+        sensor_id_cache[raw_id] = sid
+    return sid
+
+def decode_frames(buffer: bytes) -> List[tuple]:
+    # buffer holds any number of back-to-back 30-byte frames
+    view = memoryview(buffer)
+    decoded = list()
+    offset = 0
+    for fields in frame_struct.iter_unpack(buffer):
+        if sum(view[offset + 3:offset + 29]) % 256 == fields[8]:
+            decoded.append(fields[0:3] + (sensor_id_string(fields[3]),) + fields[4:9])
+        else:
+            reject_frame('frame_checksum_failed')
+        offset += frame_struct.size
+    return decoded
+
+def decode_hex_lines(lines: List[bytes]) -> bytes:
+    try:
+        buffer = bytes.fromhex(b''.join(lines).decode('ascii'))
+        if len(buffer) == len(lines) * frame_struct.size:
+            return buffer
+    except ValueError:
+        pass
+    # Some line is not clean hex, fall back to decoding line by line
+    frames = list()
+    for line in lines:
+        try:
+            frame = bytes.fromhex(line.decode('ascii'))
+        except ValueError:
+            reject_frame('invalid_encoding')
+            continue
+        if len(frame) != frame_struct.size:
+            reject_frame('invalid_encoding')
+            continue
+        frames.append(frame)
+    return b''.join(frames)
+
+class FrameDeduplicator:
+    # Remembers recently dispatched frame payloads (sensor id, readings, checksum). The same payload again
+    # within `window` seconds is a duplicate, whether a LoRa retransmission, an echo on the same radio or
+    # a copy heard by another radio; the first copy wins. A duplicate costs one dict lookup.
+    # Some payloads can really repeat: a THO motion event carries no counter, so a second event within the window
+    # looks exactly like a retransmission. For those (repeatable) a copy from the same source is only a duplicate
+    # within `repeat_window`, sized to the retransmission delay, well below the time between two real events.
+    # Least recently stored entries are evicted beyond `capacity`, which should exceed the frames of one window.
+    def __init__(self, window: float = 2., capacity: int = 4096, repeat_window: float = 0.5):
+        self.window = window
+        self.capacity = capacity
+        self.repeat_window = repeat_window
+        # payload to (time first seen, source)
+        self.entries = collections.OrderedDict()
+
+    def seen(self, payload: tuple, now: float, source: int = 0, repeatable: bool = False) -> bool:
+        entry = self.entries.get(payload)
+        if entry is not None and now - entry[0] <= (self.repeat_window if repeatable and entry[1] == source else self.window):
+            return True
+        self.entries[payload] = (now, source)
+        self.entries.move_to_end(payload)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return False
+
+
+def handle_dataframes(lines: List[bytes], timestamp: int, received: float = None, source: int = 0):
+    buffer = decode_hex_lines(lines)
+    if capture is not None:
+        capture.write(CaptureWriter.FRAME, timestamp, buffer, source)
+    handle_frame_buffer(buffer, timestamp, received, source)
+
+def handle_frame_buffer(buffer: bytes, timestamp: int, received: float = None, source: int = 0):
+    frames = decode_frames(buffer)
+    decoded = time.monotonic()
+    if received is not None and frames:
+        metrics.serial_to_frame.observe(decoded - received, len(frames))
+    metrics.source_frames[source] += len(frames)
+    for fields in frames:
+        # Checked before dispatch so a retransmitted or echoed THO motion frame is not counted twice;
+        # fields[3:] leaves out the signal bytes, which differ between copies. A negative extension
+        # is a motion event, which one radio can rightly hear again with the same readings. Timed by the
+        # chunk's monotonic time where there is one, the whole-second timestamp is too coarse for repeats
+        if deduplicator is not None and deduplicator.seen(fields[3:], timestamp if received is None else received,
+                                                          source, fields[6] < 0):
+            statistic['duplicate_frames'] += 1
+            metrics.source_duplicates[source] += 1
+            continue
+        try:
+            dispatch_frame(timestamp, fields, decoded)
+        except Exception as e:
+            logging.exception('[handle_frame_buffer]')
+
+def dispatch_frame(timestamp: int, fields: tuple, decoded: float = None):
+    sid = fields[3]
+    sensor = sensors.get(sid)
+    if sensor is None:
+        sensor = create_new_sensor_placeholder(sid)
+        discovery.provisional.add(sid)
+    if sid not in discovery.confirmed:
+        # Again with every frame until discovery succeeds; the negative cache spaces out the retries
+        discovery.request(sid)
+    if sid in discovery.provisional and discovery.hold(sid, timestamp, fields):
+        statistic['processed_frames'] += 1
+        return
+    with sensors_lock:
+        sensor = sensors[sid]
+        pushed_readings = sensor.pushed_readings
+        sensor.receive(timestamp, *fields)
+    # Only submits made for a frame just decoded count: windows flushed on a timer, held frames replayed
+    # and replaced sensors submit long after any decode
+    if decoded is not None and sensor.pushed_readings != pushed_readings:
+        metrics.frame_to_submit.observe(time.monotonic() - decoded)
+    statistic['processed_frames'] += 1
+
+def reject_frame(reason: str):
+    statistic[reason] += 1
+    statistic['bad_frames'] += 1
+
+def pull_remote_sensor_info(sensor_info):
     sid = sensor_info['sensor-id']
     sname = sensor_info['sensor-name']
     stype = sensor_info['sensor-type']
     interval = sensor_info['report-interval']
-    if stype == 'LoRaTHO':
-        sensor = LoRaTHOSensor(sid, sname, interval, pusher)
-    elif stype == 'LoRaTHA':
-        sensor = LoRaTHASensor(sid, sname, interval, pusher)
-    else:
-        sensor = LoRaTHSensor(sid, sname, interval, pusher)
-    sensors[sid] = sensor
+    with sensors_lock:
+        previous = sensors.get(sid)
+        # Carry over what the sensor being replaced has seen so far
+        sensor = make_sensor(stype, sid, sname, interval, pusher, slot=previous.slot if previous is not None else None)
+        if previous is not None:
+            sensor.carry_over(previous)
+        sensors[sid] = sensor
     save_config(sensors)
 
 def update_remote_sensor_info(sensor):
-    unit = {'temperature': 'degC', 'humidity': '%RH'}
-    if sensor.sensor_type == 'LoRaTHA':
-        unit['airflow'] = 'm/s'
-    elif sensor.sensor_type == 'LoRaTHO':
-        unit['occupancy'] = '/min'
     data = {
         'sensor-name': sensor.sensor_name,
         'sensor-type': sensor.sensor_type,
         'report-interval': sensor.report_interval,
-        'unit': unit,
+        'unit': sensor_units(sensor),
         'key': key
     }
-    response = requests.put(endpoint + '/' + sensor.sensor_id + '/info', json=data)
+    response = requests.put(endpoint + '/' + sensor.sensor_id + '/info', json=data, timeout=pusher.request_timeout)
 
 def create_new_sensor_placeholder(sid):
     sensor = LoRaTHSensor(sid, 'TH-' + sid[0:5], 60, pusher)
@@ -322,22 +1281,17 @@ def create_new_sensor_placeholder(sid):
 
 def register_sensor(sensor):
     current_status[0] = 'Registering New Sensor'
-    unit = {'temperature': 'degC', 'humidity': '%RH'}
-    if sensor.sensor_type == 'LoRaTHA':
-        unit['airflow'] = 'm/s'
-    elif sensor.sensor_type == 'LoRaTHO':
-        unit['occupancy'] = '/min'
     new_sensor_info = {
         'sensor-id': sensor.sensor_id,
         'sensor-name': sensor.sensor_name,
         'sensor-type': sensor.sensor_type,
         'report-interval': sensor.report_interval,
-        'unit': unit,
+        'unit': sensor_units(sensor),
         'key': key
     }
-    response = requests.post(endpoint, json=new_sensor_info)
+    response = requests.post(endpoint, json=new_sensor_info, timeout=pusher.request_timeout)
     if response.status_code == requests.codes.created:
-        response = requests.get(endpoint + '/' + sensor.sensor_id + '/info', params={'key': key})
+        response = requests.get(endpoint + '/' + sensor.sensor_id + '/info', params={'key': key}, timeout=pusher.request_timeout)
         return response.json()
     else:
         # print(response.status_code)
@@ -345,219 +1299,1432 @@ def register_sensor(sensor):
 
 
 
-def handle_unknown_sensor(sid: str):
-    response = requests.get(endpoint + '/' + sid + '/info', params={'key': key})
-    if response.status_code == requests.codes.not_found:
-        if sid in sensors:
-            register_sensor(sensors[sid])
-        else:
-            sensor = create_new_sensor_placeholder(sid)
-            register_sensor(sensor)
-    else:
-        if sid in sensors:
-            if update_remote:
-                update_remote_sensor_info(sensors[sid])
-        else:
-            pull_remote_sensor_info(response)
+class SensorDiscovery:
+    # Looks up, registers and pulls sensors on a background thread so frame decoding never waits
+    # on the endpoint. Answers are cached for ttl seconds, failures for negative_ttl seconds.
+    def __init__(self, ttl=3600, negative_ttl=60, hold_capacity=256):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # Bounded like every queue between threads. A request dropped from a full queue is not lost:
+        # dispatch_frame requests every sensor again with its next frame until discovery has confirmed it
+        self.requests = BoundedQueue(1024, 'drop-newest')
+        self.pending = set()
+        # Sensors created from a frame that discovery has not confirmed yet. Their type is not known, so their
+        # frames are held, up to hold_capacity each, and replayed through the real sensor once it is
+        self.provisional = set()
+        self.held = dict()
+        self.hold_capacity = hold_capacity
+        self.lock = threading.RLock()
+        # Sensors the endpoint has answered for
+        self.confirmed = set()
+        # sensor-id to (expiry, sensor info or None)
+        self.cache = dict()
+        self.thread = None
+
+    def request(self, sid: str):
+        if sid in self.pending:
+            return
+        entry = self.cache.get(sid)
+        if entry is not None and entry[0] > time.monotonic():
+            return
+        self.pending.add(sid)
+        if not self.requests.offer(sid):
+            self.pending.discard(sid)
 
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
 
-def collect_sensor_data(port: str = '/dev/ttyS0', baud_rate: int = 19200):
-    with serial.Serial(port, baudrate=baud_rate) as ser:
-        while not stop_signal.isSet():
+    def run(self):
+        while not stop_signal.is_set():
             try:
-                current_status[0] = 'Running'
-                b = ser.read(1)
-                serial_buffer.put((b, datetime.now()))
+                sid = self.requests.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                info = self.discover(sid)
+                self.cache[sid] = (time.monotonic() + self.ttl, info)
             except Exception as e:
-                logging.exception('[collect_sensor_data]')
+                logging.exception('[Discovery] {0}'.format(sid))
+                self.cache[sid] = (time.monotonic() + self.negative_ttl, None)
+            finally:
+                self.pending.discard(sid)
 
+    def lookup(self, sid: str):
+        response = requests.get(endpoint + '/' + sid + '/info', params={'key': key}, timeout=pusher.request_timeout)
+        if response.status_code == requests.codes.not_found:
+            return None
+        response.raise_for_status()
+        return response.json()
 
-def identify_data_frame():
-    ascii_buffer = list()
-    current_byte = b''
-    while not stop_signal.isSet():
+    def discover(self, sid: str):
+        info = self.lookup(sid)
+        if info is None:
+            sensor = sensors.get(sid) or create_new_sensor_placeholder(sid)
+            info = register_sensor(sensor)
+            self.release(sid)
+        elif sid in self.provisional or sid not in sensors:
+            with self.lock:
+                pull_remote_sensor_info(info)
+                self.release(sid)
+        elif update_remote:
+            update_remote_sensor_info(sensors[sid])
+        self.confirmed.add(sid)
+        return info
+
+    def hold(self, sid: str, timestamp: int, fields: tuple) -> bool:
+        # False if sid stopped being provisional in the meantime, so the frame goes to the sensor after all
+        with self.lock:
+            if sid not in self.provisional:
+                return False
+            held = self.held.get(sid)
+            if held is None:
+                held = self.held[sid] = collections.deque(maxlen=self.hold_capacity)
+            held.append((timestamp, fields))
+            return True
+
+    def release(self, sid: str):
+        # Replays the frames held for a provisional sensor through the sensor it turned out to be
+        with self.lock, sensors_lock:
+            sensor = sensors[sid]
+            for timestamp, fields in self.held.pop(sid, ()):
+                sensor.receive(timestamp, *fields)
+            self.provisional.discard(sid)
+
+
+class ConfigSync:
+    # Keeps the configured sensors in step with the endpoint. At start all of them are looked up at once,
+    # in bulk requests of bulk_size sensors or a bounded batch of per-sensor ones, so discovery has nothing
+    # left to ask when their first frames arrive. After that the lookups repeat every interval seconds as
+    # conditional requests (If-None-Match), and only info that really changed is applied and saved.
+    def __init__(self, bulk_size=100):
+        self.interval = 900
+        self.bulk = True
+        # Sensor ids go in the query string; 100 of them keep the URL around 3 kB
+        self.bulk_size = bulk_size
+        # ETag of each bulk reply by its sensor ids, and of each per-sensor reply (written by the lookup workers)
+        self.bulk_etags = dict()
+        self.etags = dict()
+        self.etags_lock = threading.Lock()
+        # sensor-id to the info last applied
+        self.known = dict()
+        self.session = None
+        self.thread = None
+
+    def start(self, interval=900):
+        self.interval = interval
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def run(self):
+        self.session = requests.Session()
         try:
-            last_byte = current_byte
-            current_byte, current_timestamp = serial_buffer.get()
-            ascii_buffer.append(current_byte)
-
-            if debug:
-                statistic['bytes'] += 1
-                current_status[5] = 'ReceivedBytes ' + str(statistic['bytes'])
-                log = open('byte_dump.log', 'a')
-                log.write(current_byte.hex() + ' ')
-                log.close()
-
-            if current_byte == b'\x0a' and last_byte == b'\x0d':
-
-                if debug:
-                    statistic['identified'] += 1
-                    current_status[6] = 'Identified: ' + str(statistic['identified'])
-
-                buffer = list()
-                for i in range(0, 30):
-                    bh = int.from_bytes(ascii_buffer[i * 2], byteorder='big') - 48
-                    bl = int.from_bytes(ascii_buffer[i * 2 + 1], byteorder='big') - 48
-                    bh = bh - 7 if bh > 10 else bh
-                    bl = bl - 7 if bl > 10 else bl
-                    buffer.append(bh * 16 + bl)
+            while not stop_signal.is_set():
                 try:
-                    byte_buffer = bytes(buffer)
+                    self.sync()
                 except Exception as e:
-                    logging.exception('[identify_data_frame]-Converting Bytes')
-                    ascii_buffer.clear()
-                handle_dataframe(byte_buffer, int(current_timestamp.timestamp()))
-                ascii_buffer.clear()
-
-        except Exception as e:
-            logging.exception('[identify_data_frame]')
-
-
-
+                    logging.exception('[Config sync]')
+                if not self.interval:
+                    break
+                stop_signal.wait(self.interval)
+        finally:
+            self.session.close()
+
+    def sync(self):
+        # Sensors still provisional are discovery's
+        sids = sorted(sid for sid in list(sensors) if sid not in discovery.provisional)
+        if not sids:
+            return
+        infos = None
+        if self.bulk:
+            infos = dict()
+            for i in range(0, len(sids), self.bulk_size):
+                chunk = self.fetch_bulk(sids[i:i + self.bulk_size])
+                if chunk is None:
+                    infos = None
+                    break
+                infos.update(chunk)
+        if infos is None:
+            infos = self.fetch_each(sids)
+        for sid, info in infos.items():
+            self.apply(sid, info)
+        expiry = time.monotonic() + discovery.ttl
+        for sid in sids:
+            if sid in self.known:
+                discovery.cache[sid] = (expiry, self.known[sid])
+                discovery.confirmed.add(sid)
+
+    def fetch_bulk(self, sids: List[str]):
+        # The reply maps sensor ids to the same info the per-sensor route returns; sensors the endpoint
+        # does not know are left out and registered by discovery. Returns None when there is no bulk route,
+        # or it does not take that many ids (414)
+        sids = tuple(sids)
+        headers = {'If-None-Match': self.bulk_etags[sids]} if sids in self.bulk_etags else {}
+        response = self.session.get(endpoint + '/info', params={'key': key, 'sensor-ids': ','.join(sids)},
+                                    headers=headers, timeout=pusher.request_timeout)
+        if response.status_code == requests.codes.not_modified:
+            return dict()
+        if response.status_code in (requests.codes.not_found, requests.codes.method_not_allowed, requests.codes.not_implemented,
+                                    requests.codes.request_uri_too_large):
+            logging.info('[Config sync] Endpoint has no bulk info route ({0}), looking sensors up one by one'.format(response.status_code))
+            self.bulk = False
+            return None
+        response.raise_for_status()
+        if 'ETag' in response.headers:
+            self.bulk_etags[sids] = response.headers['ETag']
+        return {sid: info for sid, info in response.json().items() if info}
+
+    def fetch_each(self, sids: List[str]):
+        infos = dict()
+        # A requests.Session is not meant to be shared between threads, every worker opens its own
+        local = threading.local()
+        sessions = list()
+
+        def fetch(sid):
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+                sessions.append(local.session)
+            return self.fetch(local.session, sid)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=pusher.upload_workers) as executor:
+            lookups = {executor.submit(fetch, sid): sid for sid in sids}
+            for future in concurrent.futures.as_completed(lookups):
+                try:
+                    info = future.result()
+                except Exception as e:
+                    logging.warning('[Config sync] {0}: {1}'.format(lookups[future], e))
+                    continue
+                if info is not None:
+                    infos[lookups[future]] = info
+        for session in sessions:
+            session.close()
+        return infos
+
+    def fetch(self, session, sid: str):
+        # None when the info has not changed since the last lookup, or the endpoint does not know the sensor
+        with self.etags_lock:
+            etag = self.etags.get(sid)
+        headers = {'If-None-Match': etag} if etag is not None else {}
+        response = session.get(endpoint + '/' + sid + '/info', params={'key': key}, headers=headers,
+                               timeout=pusher.request_timeout)
+        if response.status_code in (requests.codes.not_modified, requests.codes.not_found):
+            return None
+        response.raise_for_status()
+        if 'ETag' in response.headers:
+            with self.etags_lock:
+                self.etags[sid] = response.headers['ETag']
+        return response.json()
 
-# Console GUI
+    def apply(self, sid: str, info) -> bool:
+        # Also gets the info in every upload reply, which is mostly the same as last time: that costs one
+        # comparison, and config.json is only written when something changed
+        known = self.known.get(sid)
+        if known is not None:
+            if info == known or ('version' in info and info['version'] == known.get('version')):
+                return False
+        sensor = sensors.get(sid)
+        if sensor is None or sid in discovery.provisional:
+            return False
+        self.known[sid] = info
+        if info.get('sensor-type', sensor.sensor_type) != sensor.sensor_type:
+            pull_remote_sensor_info(info)
+            return True
+        with sensors_lock:
+            changed = sensor.update_config(info)
+        if changed:
+            save_config(sensors)
+            return True
+        return False
 
-# This application class serves as a wrapper for the initialization of curses
-# and also manages the actual forms of the application
-class HubApp(npyscreen.NPSAppManaged):
-    def onStart(self):
-        self.registerForm("MAIN", MainAppForm())
 
-    def onCleanExit(self):
+def collect_sensor_data(port: str = '/dev/ttyS0', baud_rate: int = 19200, chunk_size: int = 256, read_timeout: float = 0.05,
+                        source: int = 0):
+    while not stop_signal.isSet():
+        try:
+            with serial.Serial(port, baudrate=baud_rate, timeout=read_timeout) as ser:
+                read_serial_chunks(ser, chunk_size, source)
+        except serial.SerialException as e:
+            # USB receivers come and go, keep retrying the port
+            logging.exception('[collect_sensor_data] {0}'.format(port))
+            stop_signal.wait(5)
+
+
+def read_serial_chunks(ser, chunk_size: int = 256, source: int = 0):
+    # ser is anything with pyserial's in_waiting/read(), so tests and benchmarks can inject a reader.
+    # source is the index of the port in serial_sources and travels with every chunk.
+    current_status[0] = 'Running'
+    while not stop_signal.isSet():
+        try:
+            # Take whatever is waiting (bounded), or block up to the read timeout for the next byte
+            chunk = ser.read(clamp(ser.in_waiting, 1, chunk_size))
+            if chunk:
+                # Wall-clock time for the readings, read per chunk so NTP steps after boot are followed;
+                # the monotonic one only for latency metrics
+                serial_buffer.offer((source, chunk, time.monotonic(), time.time()))
+        except serial.SerialException as e:
+            raise
+        except Exception as e:
+            logging.exception('[collect_sensor_data]')
+
+
+class FrameRing:
+    # Single-producer single-consumer ring of binary frames in shared memory, from the ingest process to the hub.
+    # The producer only writes the write index and the counters, the consumer only the read index. Indexes are
+    # 32-bit (an aligned 32-bit store is atomic, also on the Pi Zero's 32-bit ARM) and wrap modulo 2 ** 32, so
+    # the capacity must be a power of two.
+    # Python gives no memory barrier between the stores, and ARM may make the write index visible before the
+    # slot bytes, so the index only bounds the read: each slot ends with a commit word, stored after its frame,
+    # holding the index it was written at plus one. The consumer checks the word before and after copying a
+    # frame, and stops at the first slot that does not match; that slot is read on the next call.
+    # Layout: write index, read index, the ingest process's counters, then the slots.
+    index = struct.Struct('<I')
+    # CLOCK_MONOTONIC time the chunk was read (the same clock in both processes), its wall-clock second,
+    # source port, frame
+    slot = struct.Struct('<dIB30sx')
+    # slot, then its commit word
+    slot_size = slot.size + index.size
+    # statistic keys counted in the ingest process, then frames dropped on a full ring, then bytes per source
+    counter_names = ('bytes', 'identified', 'discarded_bytes', 'invalid_frame_size', 'invalid_encoding', 'bad_frames')
+    max_sources = 16
+    counters = struct.Struct('<{0}Q'.format(len(counter_names) + 1 + max_sources))
+    slots_offset = 8 + counters.size
+
+    def __init__(self, buffer, capacity: int):
+        if capacity & (capacity - 1):
+            raise ValueError('FrameRing capacity must be a power of two')
+        self.buffer = buffer
+        self.capacity = capacity
+        self.read_index = self.index.unpack_from(buffer, 4)[0]
+        self.dropped = 0
+        self.high_water = 0
+        self.last_counts = self.counters.unpack_from(buffer, 8)
+
+    @classmethod
+    def size(cls, capacity: int) -> int:
+        return cls.slots_offset + capacity * cls.slot_size
+
+    @property
+    def depth(self) -> int:
+        return (self.index.unpack_from(self.buffer, 0)[0] - self.read_index) & 0xffffffff
+
+    # Producer side, in the ingest process
+
+    def write(self, received: float, timestamp: int, source: int, frame: bytes) -> bool:
+        head = self.index.unpack_from(self.buffer, 0)[0]
+        if (head - self.index.unpack_from(self.buffer, 4)[0]) & 0xffffffff >= self.capacity:
+            # Never wait for the hub: the serial side must keep reading
+            self.dropped += 1
+            return False
+        offset = self.slots_offset + (head & (self.capacity - 1)) * self.slot_size
+        self.slot.pack_into(self.buffer, offset, received, timestamp, source, frame)
+        self.index.pack_into(self.buffer, offset + self.slot.size, (head + 1) & 0xffffffff)
+        self.index.pack_into(self.buffer, 0, (head + 1) & 0xffffffff)
+        return True
+
+    def publish(self, statistic: Dict[str, int], source_bytes: Dict[int, int]):
+        self.counters.pack_into(self.buffer, 8, *[statistic[name] for name in self.counter_names], self.dropped,
+                                *[source_bytes[source] for source in range(self.max_sources)])
+
+    # Consumer side, in the hub
+
+    def read(self, limit: int) -> List[tuple]:
+        available = self.depth
+        if available > self.high_water:
+            self.high_water = available
+        position = self.read_index
+        mask = self.capacity - 1
+        frames = []
+        for _ in range(min(available, limit)):
+            offset = self.slots_offset + (position & mask) * self.slot_size
+            commit = (position + 1) & 0xffffffff
+            if self.index.unpack_from(self.buffer, offset + self.slot.size)[0] != commit:
+                # Not committed yet, seen through a write index that became visible first
+                break
+            frame = self.slot.unpack_from(self.buffer, offset)
+            if self.index.unpack_from(self.buffer, offset + self.slot.size)[0] != commit:
+                break
+            frames.append(frame)
+            position = commit
+        if frames:
+            self.read_index = position
+            self.index.pack_into(self.buffer, 4, position)
+        return frames
+
+    def collect(self, statistic: Dict[str, int], source_bytes: Dict[int, int]):
+        # Adds what the ingest process counted since the last call
+        counts = self.counters.unpack_from(self.buffer, 8)
+        last = self.last_counts
+        for i, name in enumerate(self.counter_names):
+            statistic[name] += counts[i] - last[i]
+        self.dropped = counts[len(self.counter_names)]
+        for source in range(self.max_sources):
+            i = len(self.counter_names) + 1 + source
+            if counts[i] != last[i]:
+                source_bytes[source] += counts[i] - last[i]
+        self.last_counts = counts
+
+
+def ingest_worker(ports: List[tuple], memory_name: str, capacity: int, stop_event, capture_settings=None, buffer_settings=None):
+    # Main function of the ingest process: serial readers and framing, publishing binary frames to the FrameRing
+    global capture, serial_buffer
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_signal.set())
+    # The hub owns the segment and unlinks it; spawned, this process shares the hub's resource tracker
+    memory = shared_memory.SharedMemory(name=memory_name)
+    ring = FrameRing(memory.buf, capacity)
+    if capture_settings:
+        capture = CaptureWriter(*capture_settings)
+    if buffer_settings:
+        serial_buffer = BoundedQueue(*buffer_settings)
+
+    def publish(lines, timestamp, received, source):
+        buffer = decode_hex_lines(lines)
+        if capture is not None:
+            capture.write(CaptureWriter.FRAME, timestamp, buffer, source)
+        for offset in range(0, len(buffer) - frame_struct.size + 1, frame_struct.size):
+            ring.write(received, timestamp, source, buffer[offset:offset + frame_struct.size])
+
+    def watch():
+        # Counters twice a second; stop with the hub, or without it if it is gone
+        parent = os.getppid()
+        while not stop_event.wait(0.5) and os.getppid() == parent:
+            ring.publish(statistic, metrics.source_bytes)
         stop_signal.set()
 
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+    readers = [threading.Thread(target=collect_sensor_data, args=(port, baud_rate), kwargs={'source': source})
+               for source, (port, baud_rate) in enumerate(ports)]
+    for reader in readers:
+        reader.start()
+    identify_data_frame(publish)
+    for reader in readers + [watcher]:
+        reader.join()
+    ring.publish(statistic, metrics.source_bytes)
+    if capture is not None:
+        capture.close()
+    ring.buffer = None
+    memory.close()
+
+
+class IngestProcess:
+    # Serial readers and framing in a process of their own, so uploads, sensor logic and the UI cannot hold
+    # the GIL while a radio's bytes are waiting. The frames come back through a FrameRing in shared memory.
+    def __init__(self, ports: List[tuple], capacity: int = 8192, capture_settings=None, buffer_settings=None):
+        context = multiprocessing.get_context('spawn')
+        self.memory = shared_memory.SharedMemory(create=True, size=FrameRing.size(capacity))
+        # Zeroed commit words never match: the first slot's is 1
+        self.memory.buf[:] = bytes(self.memory.size)
+        self.ring = FrameRing(self.memory.buf, capacity)
+        self.stop_event = context.Event()
+        self.process = context.Process(target=ingest_worker, name='hub-ingest', daemon=True,
+                                       args=(ports, self.memory.name, capacity, self.stop_event, capture_settings, buffer_settings))
 
-# This form class defines the display that will be presented to the user.
-class MainAppForm(npyscreen.Form):
-    def create(self):
-        self.update_thread = None
-        self.update_stop_signal = threading.Event()
+    def start(self):
+        self.process.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.process.join(10)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+    def close(self):
+        self.ring.buffer = None
+        self.memory.close()
+        self.memory.unlink()
+
+
+def consume_ring(ring: FrameRing, limit: int = 512) -> int:
+    ring.collect(statistic, metrics.source_bytes)
+    frames = ring.read(limit)
+    # Frames of one chunk go through decoding together, like the lines of a chunk in identify_data_frame
+    start = 0
+    for end in range(1, len(frames) + 1):
+        if end == len(frames) or frames[end][0:3] != frames[start][0:3]:
+            received, timestamp, source = frames[start][0:3]
+            handle_frame_buffer(b''.join(frame[3] for frame in frames[start:end]), timestamp, received, source)
+            start = end
+    return len(frames)
+
+
+def consume_frames(ring: FrameRing):
+    # Takes the place of identify_data_frame when frames come from the ingest process
+    last_flush = time.monotonic()
+    while not stop_signal.is_set():
+        try:
+            if aggregation == 'window' and time.monotonic() - last_flush >= 1:
+                last_flush = time.monotonic()
+                flush_windows(time.time())
+            if consume_ring(ring):
+                current_status[0] = 'Running'
+            else:
+                stop_signal.wait(0.005)
+        except Exception as e:
+            logging.exception('[consume_frames]')
+
+
+class FrameParser:
+    # Incremental framer for the receiver's line format: 60 ASCII hex characters terminated by CR/LF.
+    # Complete lines are cut out of a bytearray as chunks arrive; the buffer never holds more than
+    # max_line bytes, so a receiver that stops sending CR/LF cannot grow it without limit.
+    def __init__(self, frame_length: int = 60, max_line: int = 256):
+        self.frame_length = frame_length
+        self.max_line = max_line
+        self.buffer = bytearray()
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        buffer = self.buffer
+        buffer += chunk
+        lines = list()
+        start = 0
+        end = buffer.find(b'\r\n')
+        while end >= 0:
+            length = end - start
+            if length >= self.frame_length:
+                # Anything ahead of the last frame_length characters is line noise
+                if length > self.frame_length:
+                    statistic['discarded_bytes'] += length - self.frame_length
+                lines.append(bytes(buffer[end - self.frame_length:end]))
+            elif length > 0:
+                reject_frame('invalid_frame_size')
+            start = end + 2
+            end = buffer.find(b'\r\n', start)
+        del buffer[:start]
+        if len(buffer) > self.max_line:
+            # No delimiter in sight, keep only what can still be the tail of a frame (plus a dangling CR)
+            keep = self.frame_length + 1
+            statistic['discarded_bytes'] += len(buffer) - keep
+            del buffer[:len(buffer) - keep]
+        return lines
+
+
+class CaptureWriter:
+    # Binary capture of received serial chunks and decoded frames. Each file starts with a '<4sI' header
+    # (magic, version), then each record is a '<BBdI' header (kind, source port, wall-clock timestamp, length)
+    # followed by the raw bytes, written through one buffered file. Files without the header are version 1,
+    # from before there were several ports: '<BdI' records without the source. The file is rotated to
+    # .1, .2, ... once it reaches segment_size bytes; with segments > 0 only that many old segments are kept,
+    # so the capture holds roughly the last (segments + 1) * segment_size bytes.
+    CHUNK = 0
+    FRAME = 1
+
+    file_header = struct.Struct('<4sI')
+    magic = b'HCAP'
+    version = 2
+    record_headers = {1: struct.Struct('<BdI'), 2: struct.Struct('<BBdI')}
+    record_header = record_headers[version]
+
+    def __init__(self, path='capture.bin', segment_size=4 * 1024 * 1024, segments=4):
+        self.path = path
+        self.segment_size = segment_size
+        self.segments = segments
+        self.lock = threading.Lock()
+        self.file = None
+        if os.path.exists(self.path) and os.path.getsize(self.path) and capture_version(self.path) != self.version:
+            # Never append to a capture of another version
+            self.rotate()
+        else:
+            self.open()
+
+    def open(self):
+        self.file = open(self.path, 'ab', buffering=64 * 1024)
+        self.size = self.file.tell()
+        if not self.size:
+            self.file.write(CaptureWriter.file_header.pack(CaptureWriter.magic, CaptureWriter.version))
+            self.size = CaptureWriter.file_header.size
+
+    def write(self, kind: int, timestamp: float, data: bytes, source: int = 0):
+        with self.lock:
+            self.file.write(CaptureWriter.record_header.pack(kind, source, timestamp, len(data)))
+            self.file.write(data)
+            self.size += CaptureWriter.record_header.size + len(data)
+            if self.size >= self.segment_size:
+                self.rotate()
+
+    def rotate(self):
+        # Called with self.lock held
+        if self.file is not None:
+            self.file.close()
+        index = 1
+        while os.path.exists('{0}.{1}'.format(self.path, index)):
+            index += 1
+        for i in range(index, 0, -1):
+            source = '{0}.{1}'.format(self.path, i - 1) if i > 1 else self.path
+            if self.segments and i > self.segments:
+                if os.path.exists(source):
+                    os.remove(source)
+                continue
+            if os.path.exists(source):
+                os.replace(source, '{0}.{1}'.format(self.path, i))
+        self.open()
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def capture_files(path: str) -> List[str]:
+    # A capture and its rotated segments, oldest first
+    files = list()
+    index = 1
+    while os.path.exists('{0}.{1}'.format(path, index)):
+        files.append('{0}.{1}'.format(path, index))
+        index += 1
+    files.reverse()
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def capture_version(path: str) -> int:
+    with open(path, 'rb') as fp:
+        head = fp.read(CaptureWriter.file_header.size)
+    if len(head) == CaptureWriter.file_header.size:
+        magic, version = CaptureWriter.file_header.unpack(head)
+        if magic == CaptureWriter.magic:
+            return version
+    return 1
+
+
+def read_capture(path: str):
+    version = capture_version(path)
+    if version not in CaptureWriter.record_headers:
+        raise ValueError('{0}: unsupported capture version {1}'.format(path, version))
+    header = CaptureWriter.record_headers[version]
+    with open(path, 'rb') as fp:
+        if version > 1:
+            fp.seek(CaptureWriter.file_header.size)
+        while True:
+            head = fp.read(header.size)
+            if len(head) < header.size:
+                return
+            if version == 1:
+                kind, timestamp, length = header.unpack(head)
+                source = 0
+            else:
+                kind, source, timestamp, length = header.unpack(head)
+            data = fp.read(length)
+            if len(data) < length:
+                # Record cut short by a crash or a rotation in progress
+                return
+            yield kind, source, timestamp, data
+
+
+def replay_capture(paths: List[str]) -> int:
+    # Feeds captured serial chunks back through the parser as fast as they can be decoded
+    parsers = dict()
+    chunks = 0
+    for path in paths:
+        for segment in capture_files(path):
+            for kind, source, timestamp, data in read_capture(segment):
+                if kind != CaptureWriter.CHUNK:
+                    continue
+                chunks += 1
+                if source not in parsers:
+                    parsers[source] = FrameParser()
+                lines = parsers[source].feed(data)
+                if lines:
+                    handle_dataframes(lines, int(timestamp), source=source)
+    if aggregation == 'window':
+        # The capture ends, so do the windows still open, like at shutdown
+        flush_windows(float('inf'))
+    return chunks
+
+
+def flush_windows(now: float):
+    for sensor in list(sensors.values()):
+        with sensors_lock:
+            sensor.close_window(now)
+
+
+def identify_data_frame(handle=None):
+    # One framer per serial port, all feeding the same decode/dispatch path.
+    # handle takes the framed lines, handle_dataframes unless this runs in the ingest process
+    handle = handle or handle_dataframes
+    parsers = dict()
+    last_flush = time.monotonic()
+    while not stop_signal.isSet():
+        try:
+            if aggregation == 'window' and time.monotonic() - last_flush >= 1:
+                # Close windows of sensors that went quiet
+                last_flush = time.monotonic()
+                flush_windows(time.time())
+            try:
+                source, chunk, chunk_timestamp, chunk_time = serial_buffer.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            statistic['bytes'] += len(chunk)
+            metrics.source_bytes[source] += len(chunk)
+            if capture is not None:
+                capture.write(CaptureWriter.CHUNK, chunk_time, chunk, source)
+
+            parser = parsers.get(source)
+            if parser is None:
+                parser = parsers[source] = FrameParser()
+            lines = parser.feed(chunk)
+            if not lines:
+                continue
+            timestamp = int(chunk_time)
+            statistic['identified'] += len(lines)
+            handle(lines, timestamp, chunk_timestamp, source)
 
-        self.title = self.add(npyscreen.TitleFixedText, name='Sensor Hub System v{0}'.format(version))
-        self.status = self.add(npyscreen.TitleFixedText, name='Status', value='initialized')
-        self.clock = self.add(npyscreen.TitleFixedText, name='Current Time', value='')
+        except Exception as e:
+            logging.exception('[identify_data_frame]')
 
-        self.add(npyscreen.TitleFixedText, name=' ')
 
-        self.add(npyscreen.TitleFixedText, name=' ', value='Sensor      Pushed    Current Reading')
 
-        self.sensor_list = self.add(npyscreen.TitlePager, name='Sensors', values=[])
-        self.sensor_index = dict()
 
-        self.start_update()
+class SensorHistory:
+    # Recent readings of one sensor in a fixed-size ring file mapped into memory, so it survives restarts.
+    # The header counts the readings ever appended; reading i is in slot i % capacity. Readings are appended
+    # in time order, which keeps the ring sorted for range queries.
+    # Header: magic, capacity, record size, readings written, padded to 24 bytes so records are 8-byte aligned
+    header = struct.Struct('<4sIIQ4x')
+    # timestamp, temperature, humidity, value, battery, rssi, snr
+    record = struct.Struct('<dfffHBB')
+    fields = ('timestamp', 'temperature', 'humidity', 'value', 'battery', 'rssi', 'snr')
+    magic = b'HRB1'
 
-    def afterEditing(self):
-        self.stop_update()
-        self.parentApp.setNextForm(None)
+    def __init__(self, path: str, capacity: int):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        size = self.header.size + capacity * self.record.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            existing = os.fstat(fd).st_size
+            if existing != size:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, file_capacity, record_size, self.written = self.header.unpack_from(self.map, 0)
+        if existing != size or magic != self.magic or file_capacity != capacity or record_size != self.record.size:
+            # New file, or one written with another capacity or format: start over
+            self.written = 0
+            self.header.pack_into(self.map, 0, self.magic, capacity, self.record.size, 0)
+
+    def append(self, timestamp, temperature, humidity, value, battery, rssi, snr):
+        with self.lock:
+            self.record.pack_into(self.map, self.header.size + self.written % self.capacity * self.record.size,
+                                  timestamp, temperature, humidity, value, battery, rssi, snr)
+            self.written += 1
+            # Record first, then the count, so a reader never sees a slot that is not written yet
+            struct.pack_into('<Q', self.map, 12, self.written)
+
+    def reading(self, i: int) -> tuple:
+        return self.record.unpack_from(self.map, self.header.size + i % self.capacity * self.record.size)
+
+    def search(self, timestamp: float, first: int, end: int) -> int:
+        # First reading index in [first, end) at or after timestamp
+        while first < end:
+            middle = (first + end) // 2
+            if struct.unpack_from('<d', self.map, self.header.size + middle % self.capacity * self.record.size)[0] < timestamp:
+                first = middle + 1
+            else:
+                end = middle
+        return first
+
+    def latest(self, count: int = 1) -> List[tuple]:
+        with self.lock:
+            return [self.reading(i) for i in range(max(0, self.written - self.capacity, self.written - count), self.written)]
+
+    def between(self, start: float, end: float) -> List[tuple]:
+        with self.lock:
+            first = max(0, self.written - self.capacity)
+            return [self.reading(i) for i in range(self.search(start, first, self.written), self.search(end, first, self.written))]
+
+    def downsample(self, start: float, end: float, step: float) -> List[tuple]:
+        # One row per step-second bucket that has readings: bucket start, then the mean of each field,
+        # except battery which is the last one
+        if not step > 0 or not math.isfinite(step):
+            raise ValueError('step must be a positive number of seconds')
+        buckets = list()
+        for reading in self.between(start, end):
+            bucket = start + (reading[0] - start) // step * step
+            if not buckets or buckets[-1][0] != bucket:
+                buckets.append([bucket, 0, [0.] * 6])
+            buckets[-1][1] += 1
+            sums = buckets[-1][2]
+            for i in range(6):
+                sums[i] = reading[i + 1] if i == 3 else sums[i] + reading[i + 1]
+        return [(bucket, sums[0] / count, sums[1] / count, sums[2] / count, sums[3], sums[4] / count, sums[5] / count)
+                for bucket, count, sums in buckets]
+
+    def flush(self):
+        with self.lock:
+            self.map.flush()
+
+    def close(self):
+        with self.lock:
+            self.map.flush()
+            self.map.close()
+
+
+class ReadingHistory:
+    # A SensorHistory ring per sensor, as <sensor id>.ring files in one directory, opened on first use.
+    # The rings are written back to disk every flush_interval seconds, so a crash loses at most that much
+    def __init__(self, directory='history', capacity=4096):
+        self.directory = directory
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.rings = dict()
+        self.thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self, flush_interval=10.):
+        self.thread = threading.Thread(target=self.run, args=(flush_interval,))
+        self.thread.start()
+
+    def run(self, flush_interval):
+        while not stop_signal.wait(flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.exception('[History]')
+
+    def flush(self):
+        for ring in list(self.rings.values()):
+            ring.flush()
+
+    def ring(self, sensor_id: str, create: bool = True):
+        ring = self.rings.get(sensor_id)
+        if ring is None:
+            # Sensor ids are base32, anything else cannot name a ring
+            if not sensor_id.isalnum():
+                return None
+            path = os.path.join(self.directory, sensor_id + '.ring')
+            if not create and not os.path.exists(path):
+                return None
+            with self.lock:
+                ring = self.rings.get(sensor_id)
+                if ring is None:
+                    ring = self.rings[sensor_id] = SensorHistory(path, self.capacity)
+        return ring
+
+    def append(self, sensor_id, timestamp, temperature, humidity, value, battery, rssi, snr):
+        self.ring(sensor_id).append(timestamp, temperature, humidity, value, battery, rssi, snr)
+
+    def sensors(self) -> List[str]:
+        return sorted(name[:-5] for name in os.listdir(self.directory) if name.endswith('.ring'))
+
+    def query(self, sensor_id: str, params: Dict[str, List[str]]):
+        # latest=N, or start/end (epoch seconds, default the last hour) with an optional step to downsample.
+        # Returns None for an unknown sensor
+        ring = self.ring(sensor_id, create=False)
+        if ring is None:
+            return None
+        if 'latest' in params:
+            count = int(params['latest'][0])
+            if count < 0:
+                raise ValueError('latest must not be negative')
+            readings = ring.latest(count)
+        else:
+            end = float(params.get('end', [time.time()])[0])
+            start = float(params.get('start', [end - 3600])[0])
+            if 'step' in params:
+                readings = ring.downsample(start, end, float(params['step'][0]))
+            else:
+                readings = ring.between(start, end)
+        return [dict(zip(SensorHistory.fields, reading)) for reading in readings]
+
+    def close(self):
+        # Called once the hub is stopping, which also ends the flush thread
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            for ring in self.rings.values():
+                ring.close()
+            self.rings.clear()
+
+
+class Histogram:
+    # Cumulative-bucket histogram in Prometheus' layout; observe() is a bisect and two additions
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float, count: int = 1):
+        self.counts[bisect.bisect_left(self.buckets, value)] += count
+        self.sum += value * count
+        self.count += count
+
+
+class Metrics:
+    # Everything the hot path touches is a counter in `statistic`, a histogram or a dict store;
+    # formatting happens only when /metrics is scraped or the UI redraws.
+    def __init__(self):
+        self.serial_to_frame = Histogram((0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.))
+        self.frame_to_submit = Histogram((0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1))
+        # Measured from the reading's own timestamp to the server's acknowledgement
+        self.submit_to_ack = Histogram((1., 5., 10., 30., 60., 300., 900., 3600., 21600., 86400.))
+        # serial source index to bytes read / frames decoded
+        self.source_bytes = collections.Counter()
+        self.source_frames = collections.Counter()
+        self.source_duplicates = collections.Counter()
+        self.server = None
+
+    def render(self) -> str:
+        out = list()
+
+        def metric(name, kind, help_text, samples):
+            out.append('# HELP {0} {1}'.format(name, help_text))
+            out.append('# TYPE {0} {1}'.format(name, kind))
+            for labels, value in samples:
+                label_text = ','.join('{0}="{1}"'.format(k, v) for k, v in labels)
+                out.append('{0}{1} {2}'.format(name, '{' + label_text + '}' if label_text else '', value))
+
+        metric('hub_serial_bytes_total', 'counter', 'Bytes read from the serial port.', [((), statistic['bytes'])])
+        metric('hub_frames_identified_total', 'counter', 'Complete lines cut out of the serial stream.',
+               [((), statistic['identified'])])
+        metric('hub_frames_processed_total', 'counter', 'Frames decoded and dispatched to a sensor.',
+               [((), statistic['processed_frames'])])
+        metric('hub_frames_rejected_total', 'counter', 'Frames rejected by the parser.',
+               [((('reason', reason),), statistic[reason]) for reason in ('invalid_frame_size', 'invalid_encoding', 'frame_checksum_failed')])
+        metric('hub_source_bytes_total', 'counter', 'Bytes read per serial port.',
+               [((('port', serial_source_name(source)),), count) for source, count in sorted(self.source_bytes.items())])
+        metric('hub_source_frames_total', 'counter', 'Frames decoded per serial port.',
+               [((('port', serial_source_name(source)),), count) for source, count in sorted(self.source_frames.items())])
+        metric('hub_duplicate_frames_total', 'counter', 'Frames dropped as repeats of a recent frame, per serial port.',
+               [((('port', serial_source_name(source)),), count) for source, count in sorted(self.source_duplicates.items())])
+        metric('hub_discarded_bytes_total', 'counter', 'Line noise skipped by the parser.', [((), statistic['discarded_bytes'])])
+        metric('hub_push_requests_total', 'counter', 'Upload attempts per sensor batch.',
+               [((('result', 'success'),), statistic['push_success']), ((('result', 'failure'),), statistic['push_failure'])])
+        if pusher is not None:
+            metric('hub_records_pushed_total', 'counter', 'Records acknowledged by the endpoint.', [((), pusher.pushed)])
+            metric('hub_records_queued', 'gauge', 'Records waiting for upload.', [((), pusher.queued)])
+            depths = pusher.spool.pending_by_sensor()
+            for (sensor_id, layout), buffer in list(pusher.submission_buffers.items()):
+                depths[sensor_id] = depths.get(sensor_id, 0) + len(buffer)
+            metric('hub_submission_queue_depth', 'gauge', 'Records waiting for upload per sensor.',
+                   [((('sensor', sensor_id),), depth) for sensor_id, depth in sorted(depths.items())])
+        metric('hub_serial_buffer_depth', 'gauge', 'Chunks waiting in serial_buffer.', [((), serial_buffer.qsize())])
+        queues = queue_stats()
+        metric('hub_queue_capacity', 'gauge', 'Capacity of each queue between threads; 0 is unlimited.',
+               [((('queue', name),), capacity) for name, capacity, depth, high_water, dropped in queues])
+        metric('hub_queue_depth', 'gauge', 'Items in each queue between threads.',
+               [((('queue', name),), depth) for name, capacity, depth, high_water, dropped in queues])
+        metric('hub_queue_high_water', 'gauge', 'Most items each queue has held.',
+               [((('queue', name),), high_water) for name, capacity, depth, high_water, dropped in queues])
+        metric('hub_queue_dropped_total', 'counter', 'Items dropped because their queue was full.',
+               [((('queue', name),), dropped) for name, capacity, depth, high_water, dropped in queues])
+        heard = sorted((sid, sensor.slot) for sid, sensor in list(sensors.items()) if sensor.last_reading_timestamp > 0)
+        metric('hub_sensor_rssi', 'gauge', 'Raw RSSI byte of the last frame.',
+               [((('sensor', sid),), sensor_table.rssi[slot]) for sid, slot in heard])
+        metric('hub_sensor_snr', 'gauge', 'Raw SNR byte of the last frame.',
+               [((('sensor', sid),), sensor_table.snr[slot]) for sid, slot in heard])
+
+        out.append('# HELP hub_stage_latency_seconds Latency of each pipeline stage.')
+        out.append('# TYPE hub_stage_latency_seconds histogram')
+        for stage, histogram in (('serial_to_frame', self.serial_to_frame),
+                                 ('frame_to_submit', self.frame_to_submit),
+                                 ('submit_to_ack', self.submit_to_ack)):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative += count
+                out.append('hub_stage_latency_seconds_bucket{{stage="{0}",le="{1}"}} {2}'.format(
+                    stage, '+Inf' if bound == float('inf') else bound, cumulative))
+            out.append('hub_stage_latency_seconds_sum{{stage="{0}"}} {1}'.format(stage, histogram.sum))
+            out.append('hub_stage_latency_seconds_count{{stage="{0}"}} {1}'.format(stage, histogram.count))
+        return '\n'.join(out) + '\n'
+
+    def status(self) -> dict:
+        # Served as /status for a UI attached to a daemon
+        return {
+            'status': status_line(),
+            'sensors': [{'id': sensor_id,
+                         'name': sensor.sensor_name,
+                         'type': sensor.sensor_type,
+                         'pushed': sensor.pushed_readings,
+                         'last_reading': sensor.last_reading_timestamp,
+                         'last_push': sensor.last_push_timestamp,
+                         'reading': sensor.reading_display} for sensor_id, sensor in list(sensors.items())]
+        }
+
+    def serve(self, port: int, address: str = '127.0.0.1'):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/metrics':
+                    body = metrics.render().encode('utf-8')
+                    content_type = 'text/plain; version=0.0.4'
+                elif path == '/status':
+                    body = json.dumps(metrics.status()).encode('utf-8')
+                    content_type = 'application/json'
+                elif (path == '/history' or path.startswith('/history/')) and history is not None:
+                    # /history lists the sensors with history, /history/<sensor id>?... queries one
+                    sensor_id = path[len('/history/'):]
+                    try:
+                        data = history.query(sensor_id, urllib.parse.parse_qs(self.path.partition('?')[2])) if sensor_id else history.sensors()
+                    except ValueError as e:
+                        self.send_error(400, str(e))
+                        return
+                    if data is None:
+                        self.send_error(404)
+                        return
+                    body = json.dumps(data).encode('utf-8')
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = http.server.ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def serial_source_name(source: int) -> str:
+    return serial_sources[source] if source < len(serial_sources) else str(source)
+
+
+def queue_stats() -> List[tuple]:
+    # (name, capacity, depth, high-water mark, dropped) of each queue between threads
+    stats = [('serial_buffer', serial_buffer.maxsize, serial_buffer.qsize(), serial_buffer.high_water, serial_buffer.dropped),
+             ('discovery', discovery.requests.maxsize, discovery.requests.qsize(), discovery.requests.high_water,
+              discovery.requests.dropped)]
+    if ingest is not None:
+        stats.append(('ingest_ring', ingest.ring.capacity, ingest.ring.depth, ingest.ring.high_water, ingest.ring.dropped))
+    if pusher is not None:
+        stats.append(('staging', pusher.staging_capacity, pusher.staged, pusher.staging_high_water, pusher.staging_dropped))
+        stats.append(('spool', pusher.spool_capacity, pusher.queued - pusher.staged, pusher.spool_high_water, pusher.spool_dropped))
+    return stats
+
+
+def status_line() -> List[str]:
+    status = [
+        current_status[0],
+        'Processed: {0}'.format(statistic['processed_frames']),
+        'Rejected: {0}'.format(statistic['bad_frames']),
+        'Queued/Pushed: {0}/{1}'.format(pusher.queued, pusher.pushed) if pusher is not None else '',
+        current_status[4]
+    ]
+    dropped = sum(stats[4] for stats in queue_stats())
+    if dropped:
+        status.append('Dropped: {0}'.format(dropped))
+    if debug:
+        status.append('ReceivedBytes {0}'.format(statistic['bytes']))
+        status.append('Identified: {0}'.format(statistic['identified']))
+    return status
+
+
+class SensorListView:
+    # Rows of the sensor list. A row is only reformatted when its sensor changed since the last refresh,
+    # and the list is built from a snapshot of sensors so other threads can keep adding to it meanwhile.
+    sort_orders = ('name', 'id', 'type', 'pushed', 'last reading')
+
+    def __init__(self, page_size=20):
+        self.page_size = page_size
+        self.page = 0
+        self.sort = 'name'
+        self.filter = ''
+        # sensor id -> (state the row was formatted from, row text, sensor)
+        self.rows = dict()
+        self.order = list()
+        self.dirty = True
+
+    @staticmethod
+    def format_row(sensor) -> str:
+        if sensor.last_reading_timestamp > 0:
+            return '{0:<10}  {1:<6}    {2} {3} ({4})'.format(
+                sensor.sensor_name[0:10],
+                sensor.pushed_readings,
+                sensor.reading_display,
+                datetime.fromtimestamp(sensor.last_reading_timestamp),
+                'P' if sensor.last_reading_timestamp == sensor.last_push_timestamp else 'D'
+            )
+        return '{0:<10}  {1:<6}    {2}'.format(sensor.sensor_name[0:10], sensor.pushed_readings, sensor.reading_display)
+
+    def sort_key(self, sensor_id):
+        sensor = self.rows[sensor_id][2]
+        if self.sort == 'id':
+            return sensor_id
+        if self.sort == 'type':
+            return sensor.sensor_type or '', sensor.sensor_name
+        if self.sort == 'pushed':
+            return -sensor.pushed_readings
+        if self.sort == 'last reading':
+            return -sensor.last_reading_timestamp
+        return sensor.sensor_name
+
+    def refresh(self, sensors: Dict[str, 'Sensor']) -> bool:
+        # Returns True when the visible page changed
+        snapshot = list(sensors.items())
+        changed = self.dirty
+        for sensor_id, sensor in snapshot:
+            state = (sensor, sensor.sensor_name, sensor.pushed_readings, sensor.last_reading_timestamp, sensor.last_push_timestamp)
+            row = self.rows.get(sensor_id)
+            if row is None or row[0] != state:
+                self.rows[sensor_id] = (state, self.format_row(sensor), sensor)
+                changed = True
+        if len(self.rows) != len(snapshot):
+            current = {sensor_id for sensor_id, sensor in snapshot}
+            for sensor_id in [sensor_id for sensor_id in self.rows if sensor_id not in current]:
+                del self.rows[sensor_id]
+            changed = True
+        if changed:
+            needle = self.filter.lower()
+            order = [sensor_id for sensor_id, row in self.rows.items()
+                     if not needle or needle in sensor_id.lower() or needle in row[2].sensor_name.lower()
+                     or needle in (row[2].sensor_type or '').lower()]
+            order.sort(key=self.sort_key)
+            self.order = order
+            self.page = min(self.page, self.pages - 1)
+        self.dirty = False
+        return changed
+
+    @property
+    def pages(self) -> int:
+        return max(1, -(-len(self.order) // self.page_size))
+
+    def visible(self) -> List[str]:
+        start = self.page * self.page_size
+        return [self.rows[sensor_id][1] for sensor_id in self.order[start:start + self.page_size]]
+
+    def summary(self) -> str:
+        return 'Page {0}/{1}  {2} sensors  Sorted by {3}{4}'.format(
+            self.page + 1, self.pages, len(self.order), self.sort, '  Filter: ' + self.filter if self.filter else '')
+
+    def set_filter(self, text: str):
+        if text != self.filter:
+            self.filter = text
+            self.page = 0
+            self.dirty = True
+
+    def next_page(self):
+        if self.page + 1 < self.pages:
+            self.page += 1
+            self.dirty = True
+
+    def previous_page(self):
+        if self.page > 0:
+            self.page -= 1
+            self.dirty = True
+
+    def next_sort(self):
+        self.sort = self.sort_orders[(self.sort_orders.index(self.sort) + 1) % len(self.sort_orders)]
+        self.dirty = True
+
+
+class LocalStatus:
+    # What the UI shows when it runs in the same process as the pipeline
+    def __init__(self):
+        self.status = list()
+        self.sensors = sensors
+
+    def poll(self):
+        self.status = status_line()
+        self.sensors = sensors
+
+
+class SensorStatus:
+    # Stand-in for a Sensor in an attached UI, with the attributes SensorListView reads
+    __slots__ = ('sensor_id', 'sensor_name', 'sensor_type', 'pushed_readings', 'last_reading_timestamp',
+                 'last_push_timestamp', 'reading_display')
+
+
+class DaemonStatus:
+    # What the UI shows when attached to a hub running with --daemon, read from its /status
+    def __init__(self, url):
+        self.url = url.rstrip('/') + '/status'
+        self.status = ['Connecting to {0}'.format(url)]
+        # Kept across polls so unchanged sensors keep their rows
+        self.sensors = dict()
+
+    def poll(self):
+        try:
+            data = requests.get(self.url, timeout=2).json()
+        except Exception as e:
+            self.status = ['Daemon unreachable: {0}'.format(e)]
+            return
+        self.status = data['status']
+        current = dict()
+        for entry in data['sensors']:
+            sensor = self.sensors.get(entry['id']) or SensorStatus()
+            sensor.sensor_id = entry['id']
+            sensor.sensor_name = entry['name']
+            sensor.sensor_type = entry['type']
+            sensor.pushed_readings = entry['pushed']
+            sensor.last_reading_timestamp = entry['last_reading']
+            sensor.last_push_timestamp = entry['last_push']
+            sensor.reading_display = entry['reading']
+            current[sensor.sensor_id] = sensor
+        self.sensors = current
 
-    def set_status(self, status: str):
-        self.status.value = status
-        self.clock.display()
 
-    def start_update(self):
-        self.update_thread = threading.Thread(target=self.update)
-        self.update_thread.start()
+# Console GUI
 
-    def stop_update(self):
-        global stop_signal
-        stop_signal.set()
-        self.update_stop_signal.set()
+def hub_app(source):
+    # curses and npyscreen are only imported for the UI, a --daemon hub never loads them.
+    # source is a LocalStatus or DaemonStatus the form polls every tick.
+    import curses
+    import curses.ascii
+    import npyscreen
+
+    # This application class serves as a wrapper for the initialization of curses
+    # and also manages the actual forms of the application
+    class HubApp(npyscreen.NPSAppManaged):
+        def onStart(self):
+            self.registerForm("MAIN", MainAppForm())
+
+        def onCleanExit(self):
+            stop_signal.set()
+
+    # This form class defines the display that will be presented to the user.
+    class MainAppForm(npyscreen.Form):
+        def create(self):
+            self.update_thread = None
+            self.update_stop_signal = threading.Event()
+            # Set by key handlers so a page or sort change shows without waiting for the next tick
+            self.update_wakeup = threading.Event()
+
+            self.title = self.add(npyscreen.TitleFixedText, editable=False, name='Sensor Hub System v{0}'.format(version))
+            self.status = self.add(npyscreen.TitleFixedText, editable=False, name='Status', value='initialized')
+            self.clock = self.add(npyscreen.TitleFixedText, editable=False, name='Current Time', value='')
+
+            # Only the filter and the sensor list take the focus, Tab switches between them
+            self.filter = self.add(npyscreen.TitleText, name='Filter', value='')
+            self.view_summary = self.add(npyscreen.TitleFixedText, editable=False, name=' ', value='')
+
+            self.add(npyscreen.TitleFixedText, editable=False, name=' ', value='Sensor      Pushed    Current Reading')
+
+            self.sensor_list = self.add(npyscreen.TitlePager, name='Sensors', values=[])
+            # The pager only ever holds one page; PgUp/PgDn/Space turn pages of the view, s changes the sort order
+            self.sensor_view = SensorListView(max(1, self.sensor_list.entry_widget.height))
+            self.sensor_list.entry_widget.add_handlers({
+                curses.KEY_NPAGE: self.h_next_page,
+                curses.ascii.SP: self.h_next_page,
+                curses.KEY_PPAGE: self.h_previous_page,
+                ord('s'): self.h_next_sort,
+            })
+
+            self.start_update()
+
+        def afterEditing(self):
+            self.stop_update()
+            self.parentApp.setNextForm(None)
+
+        def set_status(self, status: str):
+            self.status.value = status
+            self.clock.display()
 
-    def update(self):
-        redraw_counter = 0
-        while True:
-            if self.update_stop_signal.isSet():
+        def h_next_page(self, _input):
+            self.sensor_view.next_page()
+            self.sensor_list.entry_widget.start_display_at = 0
+            self.update_wakeup.set()
+
+        def h_previous_page(self, _input):
+            self.sensor_view.previous_page()
+            self.sensor_list.entry_widget.start_display_at = 0
+            self.update_wakeup.set()
+
+        def h_next_sort(self, _input):
+            self.sensor_view.next_sort()
+            self.update_wakeup.set()
+
+        def start_update(self):
+            self.update_thread = threading.Thread(target=self.update)
+            self.update_thread.start()
+
+        def stop_update(self):
+            global stop_signal
+            stop_signal.set()
+            self.update_stop_signal.set()
+            self.update_wakeup.set()
+
+        def update(self):
+            status = None
+            while True:
+                if self.update_stop_signal.isSet():
+                    return
+                source.poll()
+                value = '  '.join(source.status)
+                if value != status:
+                    status = self.status.value = value
+                    self.status.display()
+
+                now = datetime.now()
+                self.clock.value = datetime.strftime(now, "%Y-%m-%d %H:%M:%S")
+                self.clock.display()
+
+                view = self.sensor_view
+                view.set_filter(self.filter.value or '')
+                if view.refresh(source.sensors):
+                    self.view_summary.value = view.summary()
+                    self.view_summary.display()
+                    self.sensor_list.values = view.visible()
+                    self.sensor_list.display()
+
+                self.update_wakeup.wait(1)
+                self.update_wakeup.clear()
+
+    return HubApp()
+
+
+class ConfigStore:
+    # config.json on disk. Saves are grouped: a change schedules one write after `delay` seconds,
+    # and nothing is written unless the sensor entries differ from the last ones written. Each write
+    # goes to a temp file that is fsynced and renamed over config.json, so a crash never leaves a
+    # truncated config behind.
+    def __init__(self, path='config.json', delay=5.):
+        self.path = path
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.config = dict()
+        self.written = None
+        self.pending = None
+        self.timer = None
+
+    def load(self):
+        with open(self.path, 'r') as fp:
+            config = json.load(fp)
+        for name in ('endpoint', 'key'):
+            if not isinstance(config.get(name), str):
+                raise ValueError('config.json: "{0}" must be a string'.format(name))
+        entries = dict()
+        for sconf in config.get('sensors', []):
+            try:
+                if not isinstance(sconf['id'], str) or not isinstance(sconf['name'], str) or not isinstance(sconf['type'], str):
+                    raise ValueError('id, name and type must be strings')
+                if not isinstance(sconf['report-interval'], (int, float)) or sconf['report-interval'] <= 0:
+                    raise ValueError('report-interval must be a positive number')
+            except (KeyError, TypeError, ValueError) as e:
+                logging.warning('[Config loading] Skipping sensor entry {0}: {1}'.format(sconf, e))
+                continue
+            # A sensor listed twice keeps its last entry
+            entries[sconf['id']] = sconf
+        config['sensors'] = list(entries.values())
+        self.config = config
+        self.written = config['sensors']
+        return config
+
+    def save(self, sensors, immediately=False):
+        entries = [sensor.to_config() for sensor in list(sensors.values())]
+        with self.lock:
+            if entries == self.written and not self.config.get('update_remote_config'):
+                self.pending = None
                 return
-            self.status.value = '  '.join(current_status)
-            self.status.display()
+            self.pending = entries
+            if immediately:
+                self.write()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.write()
+
+    def write(self):
+        # Called with self.lock held
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending is None:
+            return
+        config = dict(self.config)
+        config['update_remote_config'] = False
+        config['sensors'] = self.pending
+        directory = os.path.dirname(os.path.abspath(self.path))
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as fp:
+            json.dump(config, fp, indent=4)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_path, self.path)
+        with contextlib.suppress(OSError):
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        self.config = config
+        self.written = self.pending
+        self.pending = None
 
-            now = datetime.now()
-            self.clock.value = datetime.strftime(now, "%Y-%m-%d %H:%M:%S")
-            self.clock.display()
 
-            for sid in sensors:
-                if sid not in self.sensor_index:
-                    self.sensor_index[sid] = len(self.sensor_index)
-                    self.sensor_list.values.append('')
-                index = self.sensor_index[sid]
-
-                if sensors[sid].last_reading_timestamp > 0:
-                    self.sensor_list.values[index] = '{0:<10}  {1:<6}    {2} {3} ({4})'.format(
-                        sensors[sid].sensor_name[0:10],
-                        sensors[sid].pushed_readings,
-                        sensors[sid].reading_display,
-                        datetime.fromtimestamp(sensors[sid].last_reading_timestamp),
-                        'P' if sensors[sid].last_reading_timestamp == sensors[sid].last_push_timestamp else 'D'
-                    )
-                else:
-                    self.sensor_list.values[index] = '{0:<10}  {1:<6}    {2}'.format(
-                        sensors[sid].sensor_name[0:10],
-                        sensors[sid].pushed_readings,
-                        sensors[sid].reading_display)
-            self.sensor_list.display()
-
-            time.sleep(1)
-            if redraw_counter % 10 == 0:
-                redraw_counter = 0
-                self.DISPLAY()
-            redraw_counter += 1
-
-def load_config():
-    with open('config.json', 'r') as fp:
-        config = json.load(fp)
+def load_config(spool_file=None):
+    config = config_store.load()
     endpoint = config['endpoint']
     key = config['key']
 
-    update_remote = config['update_remote_config']
-
-    pusher = CloudEndpoint(endpoint, key)
+    update_remote = config.get('update_remote_config', False)
+
+    pusher = CloudEndpoint(endpoint, key,
+                           spool_file=spool_file or config.get('spool_file', 'spool.db'),
+                           upload_workers=config.get('upload_workers', 4),
+                           request_timeout=tuple(config.get('request_timeout', (5, 30))),
+                           upload_mode=config.get('upload_mode', 'per-sensor'),
+                           compress=config.get('compress_uploads', False),
+                           upload_batch_size=config.get('upload_batch_size', 500),
+                           retry_policy=config.get('retry_policy'),
+                           upload_format=config.get('upload_format', 'json'),
+                           staging_capacity=config.get('staging_capacity', 50000),
+                           staging_policy=config.get('staging_policy', 'drop-oldest'),
+                           spool_capacity=config.get('spool_capacity', 2000000),
+                           spool_interval=config.get('spool_interval', 1))
 
     sensors = dict()
 
+    for name, conf in config.get('airflow_calibrations', {}).items():
+        try:
+            airflow_calibrations[name] = AirflowCalibration.from_config(conf)
+        except Exception as e:
+            logging.exception('[Config loading] Airflow calibration {0}'.format(name))
+
     for sconf in config['sensors']:
         sid = sconf['id']
         sname = sconf['name']
         stype = sconf['type']
         interval = sconf['report-interval']
-        if stype == 'LoRaTHO':
-            sensor = LoRaTHOSensor(sid, sname, interval, pusher)
-        elif stype == 'LoRaTHA':
-            sensor = LoRaTHASensor(sid, sname, interval, pusher)
-        else:
-            sensor = LoRaTHSensor(sid, sname, interval, pusher)
-        sensors[sid] = sensor
+        sensors[sid] = make_sensor(stype, sid, sname, interval, pusher, sconf)
 
     return endpoint, key, pusher, sensors, update_remote
 
 
 
-def save_config(sensors):
-    with open('config.json', 'r') as fp:
-        config = json.load(fp)
-    config['update_remote_config'] = False
-    config['sensors'].clear()
-    for sensor in sensors.values():
-        config['sensors'].append({
-            'id': sensor.sensor_id,
-            'name': sensor.sensor_name,
-            'type': sensor.sensor_type,
-            'report-interval': sensor.report_interval
-        })
-    with open('config.json', 'w') as fp:
-        json.dump(config, fp)
+def save_config(sensors, immediately=False):
+    config_store.save(sensors, immediately)
+
 
+config_store = ConfigStore('config.json')
 
-if os.path.exists('./hub.lock'):
-    print('Hub is already running in another terminal.')
-    exit()
-else:
-    open('./hub.lock', 'x').close()
+sensors = {}  # sensor-id to LoRaTHASensor instance
 
+# Held while a sensor takes a reading or closes its window, and while one is replaced or reconfigured. Frames are
+# dispatched on the frame thread, but held frames are replayed on the discovery thread and sensors replaced on the
+# discovery, config sync and push threads; a replaced sensor must not take a reading after handing its window over
+sensors_lock = threading.RLock()
 
+discovery = SensorDiscovery()
 
-sensors = {}  # sensor-id to LoRaTHASensor instance
+config_sync = ConfigSync()
 
-serial_buffer = queue.Queue()
+# Chunks from the serial readers to identify_data_frame, set up from config by start_pipeline
+serial_buffer = BoundedQueue(4096, 'drop-oldest')
 
 current_status = ['Initializing', '', '', '', '', '', '', '', '', '', '', '']
 
@@ -566,30 +2733,218 @@ statistic = {
     'identified': 0,
     'invalid_frame_size': 0,
     'frame_checksum_failed': 0,
+    'invalid_encoding': 0,
     'bad_frames': 0,
-    'bytes': 0
+    'discarded_bytes': 0,
+    'bytes': 0,
+    'push_success': 0,
+    'push_failure': 0,
+    'duplicate_frames': 0
 }
 
-debug_output = ''
+# IngestProcess when serial reading and framing run in a process of their own
+ingest = None
 
+# ReadingHistory of every reading received, set up by start_pipeline when history_dir is configured
+history = None
 
-serial_thread = threading.Thread(target=collect_sensor_data)
-serial_thread.start()
+# 'throttle' submits a reading at most every report interval and drops the rest,
+# 'window' submits one summary per sensor per report-interval-aligned window
+aggregation = 'throttle'
 
-data_identify_thread = threading.Thread(target=identify_data_frame)
-data_identify_thread.start()
+# Names of the configured serial ports, indexed by the source tag on each chunk
+serial_sources = ['/dev/ttyS0']
 
-endpoint, key, pusher, sensors, update_remote = load_config()
+# FrameDeduplicator, set up from config unless duplicate_window is 0
+deduplicator = None
 
-pusher.start()
+metrics = Metrics()
 
-gui_app = HubApp()
-try:
-    gui_app.run()
-finally:
+debug_output = ''
+
+# CaptureWriter while debug is on
+capture = None
+
+
+def sd_notify(message: str):
+    # systemd service notification (Type=notify); does nothing when not started by systemd
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return
+    if address.startswith('@'):
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(message.encode('utf-8'))
+    except OSError as e:
+        logging.warning('[Notify] {0}'.format(e))
+
+
+def make_deduplicator():
+    window = config_store.config.get('duplicate_window', 2.)
+    return FrameDeduplicator(window, config_store.config.get('duplicate_capacity', 4096),
+                             config_store.config.get('duplicate_repeat_window', 0.5)) if window > 0 else None
+
+
+def start_pipeline() -> List[threading.Thread]:
+    # Everything the readers feed is set up before the first byte is read: capture, deduplication,
+    # metrics, upload and discovery, then the frame thread, then the serial readers.
+    # Returns the threads stop_pipeline() has to join, in the order to join them
+    global serial_sources, deduplicator, debug, capture, history, serial_buffer, ingest
+    debug = config_store.config.get('debug', False)
+    capture_settings = None
+    if debug:
+        capture_settings = (config_store.config.get('capture_file', 'capture.bin'),
+                            config_store.config.get('capture_segment_size', 4 * 1024 * 1024),
+                            config_store.config.get('capture_segments', 4))
+    in_process = config_store.config.get('ingest_process', False)
+    if capture_settings and not in_process:
+        capture = CaptureWriter(*capture_settings)
+
+    ports = config_store.config.get('serial_ports') or [{'port': '/dev/ttyS0', 'baud_rate': 19200}]
+    serial_sources = [pconf.get('name', pconf['port']) for pconf in ports]
+    deduplicator = make_deduplicator()
+    buffer_settings = (config_store.config.get('serial_buffer_capacity', 4096),
+                       config_store.config.get('serial_buffer_policy', 'drop-oldest'))
+    serial_buffer = BoundedQueue(*buffer_settings)
+    if config_store.config.get('history_dir', 'history'):
+        history = ReadingHistory(config_store.config.get('history_dir', 'history'), config_store.config.get('history_capacity', 4096))
+        history.start(config_store.config.get('history_flush_interval', 10))
+
+    metrics_port = config_store.config.get('metrics_port', 9108)
+    if metrics_port:
+        try:
+            # Loopback unless configured: /status and /history expose readings and sensor ids, so a scraper on
+            # another host needs metrics_address set to the interface to listen on ('' for all)
+            metrics.serve(metrics_port, config_store.config.get('metrics_address', '127.0.0.1'))
+        except OSError as e:
+            logging.exception('[Metrics]')
+
+    pusher.start()
+    discovery.start()
+    if not update_remote:
+        # With update_remote_config the local config is pushed to the endpoint by discovery instead
+        config_sync.start(config_store.config.get('config_sync_interval', 900))
+
+    if in_process:
+        # The serial readers, the framing and the capture run in the ingest process
+        ingest = IngestProcess([(pconf['port'], pconf.get('baud_rate', 19200)) for pconf in ports],
+                               config_store.config.get('ingest_ring_capacity', 8192), capture_settings, buffer_settings)
+        ingest.start()
+        consumer_thread = threading.Thread(target=consume_frames, args=(ingest.ring,))
+        consumer_thread.start()
+        return [consumer_thread]
+
+    data_identify_thread = threading.Thread(target=identify_data_frame)
+    data_identify_thread.start()
+    serial_threads = list()
+    for source, pconf in enumerate(ports):
+        serial_threads.append(threading.Thread(target=collect_sensor_data,
+                                               args=(pconf['port'], pconf.get('baud_rate', 19200)),
+                                               kwargs={'source': source}))
+        serial_threads[-1].start()
+    return serial_threads + [data_identify_thread]
+
+
+def stop_pipeline(threads: List[threading.Thread]):
     stop_signal.set()
-    serial_thread.join()
-    data_identify_thread.join()
-    os.remove('./hub.lock')
+    if ingest is not None:
+        ingest.stop()
+    for thread in threads:
+        thread.join()
+    if ingest is not None:
+        # Frames the ingest process published before it exited
+        consume_ring(ingest.ring, ingest.ring.capacity)
+        ingest.close()
+    if aggregation == 'window':
+        # Submit the windows still open, partial as they are, rather than lose them
+        flush_windows(float('inf'))
+    pusher.submission_thread.join()
+    if pusher.spool_thread is not None:
+        pusher.spool_thread.join()
+    # The last frames can be submitted after the push thread spooled for the last time
+    try:
+        pusher.spool_staged()
+    except Exception as e:
+        logging.exception('[Push] Spool')
+    held = sum(len(frames) for frames in list(discovery.held.values()))
+    if held:
+        logging.warning('[Discovery] {0} frames of {1} sensors never confirmed were not submitted'.format(held, len(discovery.held)))
+    if capture is not None:
+        capture.close()
+    metrics.stop()
+    if history is not None:
+        history.close()
+    pusher.spool.close()
+
+
+def run_daemon():
+    # Headless: no curses, stops on SIGTERM/SIGINT after spooling everything it has received
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_signal.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_signal.set())
+    threads = start_pipeline()
+    sd_notify('READY=1')
+    logging.info('[Daemon] Started')
+    # Pet the systemd watchdog, if the unit has one, at half its interval
+    watchdog = int(os.environ.get('WATCHDOG_USEC', 0)) / 2e6 or None
+    while not stop_signal.wait(watchdog):
+        sd_notify('WATCHDOG=1')
+    sd_notify('STOPPING=1')
+    logging.info('[Daemon] Stopping')
+    stop_pipeline(threads)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Sensor Hub System v{0}'.format(version))
+    arg_parser.add_argument('--replay', nargs='+', metavar='CAPTURE',
+                            help='feed capture files through the frame parser offline and exit')
+    arg_parser.add_argument('--daemon', action='store_true',
+                            help='run without the console UI, e.g. as a systemd service (Type=notify)')
+    arg_parser.add_argument('--attach', nargs='?', const='', metavar='URL',
+                            help='only show the console UI of a hub running with --daemon, '
+                                 'by default at the metrics_port in config.json')
+    args = arg_parser.parse_args()
+
+    if args.replay:
+        # Offline: nothing is uploaded and the real spool is left alone
+        endpoint, key, pusher, sensors, update_remote = load_config(spool_file=':memory:')
+        aggregation = config_store.config.get('aggregation', 'throttle')
+        deduplicator = make_deduplicator()
+        started = time.perf_counter()
+        chunks = replay_capture(args.replay)
+        elapsed = time.perf_counter() - started
+        print('Replayed {0} chunks in {1:.3f}s'.format(chunks, elapsed))
+        for name, value in statistic.items():
+            print('{0}: {1}'.format(name, value))
+        print('submitted: {0}'.format(pusher.queued))
+        # Offline nothing tells what the sensors missing from config.json are
+        print('held for unknown sensors: {0}'.format(sum(len(frames) for frames in discovery.held.values())))
+        exit()
+
+    if args.attach is not None:
+        url = args.attach or 'http://127.0.0.1:{0}'.format(ConfigStore('config.json').load().get('metrics_port', 9108))
+        hub_app(DaemonStatus(url)).run()
+        exit()
+
+    if os.path.exists('./hub.lock'):
+        print('Hub is already running, use --attach to show its console.')
+        exit()
+    else:
+        open('./hub.lock', 'x').close()
+
+    try:
+        endpoint, key, pusher, sensors, update_remote = load_config()
+        aggregation = config_store.config.get('aggregation', 'throttle')
+        if args.daemon:
+            run_daemon()
+        else:
+            threads = start_pipeline()
+            try:
+                hub_app(LocalStatus()).run()
+            finally:
+                stop_pipeline(threads)
+    finally:
+        os.remove('./hub.lock')
 
 # generate_simulation_data()
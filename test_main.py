@@ -0,0 +1,357 @@
+import json
+import math
+import os
+import tempfile
+import unittest
+
+import main
+
+
+def frame_line(temperature=21.5, humidity=40., extension=0., battery=3000, raw_id=b'\x01' * 12):
+    payload = main.struct.pack('>12sfffH', raw_id, temperature, humidity, extension, battery)
+    return (bytes([180, 10, 190]) + payload + bytes([sum(payload) % 256])).hex().upper().encode()
+
+
+class FrameParserTest(unittest.TestCase):
+    def setUp(self):
+        self.statistic = dict(main.statistic)
+
+    def tearDown(self):
+        main.statistic.update(self.statistic)
+
+    def test_lines_split_across_chunks(self):
+        parser = main.FrameParser()
+        line = frame_line()
+        self.assertEqual(parser.feed(line[:25]), [])
+        self.assertEqual(parser.feed(line[25:] + b'\r\n' + line[:10]), [line])
+        self.assertEqual(parser.feed(line[10:] + b'\r\n'), [line])
+
+    def test_noise_ahead_of_a_frame_is_discarded(self):
+        parser = main.FrameParser()
+        discarded = main.statistic['discarded_bytes']
+        self.assertEqual(parser.feed(b'\x00\xffnoise' + frame_line() + b'\r\n'), [frame_line()])
+        self.assertEqual(main.statistic['discarded_bytes'] - discarded, 7)
+
+    def test_short_line_is_rejected(self):
+        parser = main.FrameParser()
+        rejected = main.statistic['invalid_frame_size']
+        self.assertEqual(parser.feed(frame_line()[:40] + b'\r\n'), [])
+        self.assertEqual(main.statistic['invalid_frame_size'] - rejected, 1)
+
+    def test_buffer_stays_bounded_without_delimiters(self):
+        parser = main.FrameParser()
+        for _ in range(100):
+            parser.feed(b'A' * 100)
+        self.assertLessEqual(len(parser.buffer), parser.max_line)
+        # Still resynchronises on the next delimited frame; the kept tail is cut out as a line of its own
+        # and left to the checksum
+        self.assertEqual(parser.feed(b'\r\n' + frame_line() + b'\r\n')[-1], frame_line())
+
+    def test_decoded_frame_fields(self):
+        buffer = main.decode_hex_lines([frame_line(temperature=20., battery=3100)])
+        fields, = main.decode_frames(buffer)
+        self.assertEqual(fields[3], main.sensor_id_string(b'\x01' * 12))
+        self.assertEqual(fields[4], 20.)
+        self.assertEqual(fields[7], 3100)
+
+
+class CompactCodecTest(unittest.TestCase):
+    def buffer(self, layout, rows):
+        buffer = main.SubmissionBuffer(layout)
+        for timestamp, values in rows:
+            buffer.append(timestamp, values)
+        return buffer
+
+    def test_round_trip_matches_json_body(self):
+        batches = {
+            'A': [self.buffer(main.LoRaTHSensor.layout, [(1700000000, (21.25, 40.5, 3012)), (1700000060, (-3.5, 99.99, 2999))])],
+            'B': [self.buffer(main.LoRaTHOSensor.layout, [(1700000000, (20., 30., 4, 3100))]),
+                  self.buffer(main.LoRaTHOSensor.window_layout, [(1700000060, (20., 19.5, 20.5, 30., 29., 31., 2, 3100, 12))])],
+        }
+        decoded = main.decode_compact(main.encode_compact('secret', batches))
+        self.assertEqual(decoded['key'], 'secret')
+        for sensor_id, buffers in batches.items():
+            self.assertEqual(decoded['sensors'][sensor_id], json.loads(main.CloudEndpoint.format_records(buffers)))
+
+    def test_non_finite_and_unknown_precision_columns_are_sent_raw(self):
+        layout = main.record_layout(('temperature', 'value'), ('d', 'd'), (2, None))
+        buffer = self.buffer(layout, [(1700000000, (float('nan'), 0.123456789)), (1700000001, (1., float('inf')))])
+        records = main.decode_compact(main.encode_compact('', {'A': [buffer]}))['sensors']['A']
+        self.assertTrue(math.isnan(records[0]['value']['temperature']))
+        self.assertEqual(records[0]['value']['value'], 0.123456789)
+        self.assertEqual(records[1]['value']['value'], float('inf'))
+        self.assertEqual([record['timestamp'] for record in records], [1700000000, 1700000001])
+
+    def test_dropped_records_are_not_encoded(self):
+        buffer = self.buffer(main.LoRaTHSensor.layout, [(t, (t, t, t)) for t in range(10)])
+        for _ in range(3):
+            buffer.drop_first()
+        records = main.decode_compact(main.encode_compact('', {'A': [buffer]}))['sensors']['A']
+        self.assertEqual([record['timestamp'] for record in records], list(range(3, 10)))
+
+
+class SubmissionSpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'spool.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def buffer(self, count, start=1700000000):
+        buffer = main.SubmissionBuffer(main.LoRaTHSensor.layout)
+        for i in range(count):
+            buffer.append(start + i, (20. + i, 40., 3000))
+        return buffer
+
+    def test_batches_survive_a_restart(self):
+        spool = main.SubmissionSpool(self.path)
+        spool.append([('A', self.buffer(3)), ('B', self.buffer(2))])
+        # No close(): committed batches must be there after a crash
+        spool.db.close()
+        spool = main.SubmissionSpool(self.path)
+        self.assertEqual(spool.pending(), 5)
+        self.assertEqual(spool.pending_by_sensor(), {'A': 3, 'B': 2})
+        ids, buffers = spool.fetch('A', 100)
+        self.assertEqual(main.CloudEndpoint.format_records(buffers), main.CloudEndpoint.format_records([self.buffer(3)]))
+        spool.acknowledge(ids)
+        self.assertEqual(spool.sensors(), ['B'])
+        spool.close()
+
+    def test_pending_records_of_a_previous_run_are_queued(self):
+        spool = main.SubmissionSpool(self.path)
+        spool.append([('A', self.buffer(4))])
+        spool.close()
+        pusher = main.CloudEndpoint('http://127.0.0.1:9', '', spool_file=self.path)
+        self.assertEqual(pusher.queued, 4)
+        pusher.spool.close()
+
+    def test_staged_readings_are_spooled_between_push_cycles(self):
+        pusher = main.CloudEndpoint('http://127.0.0.1:9', '', spool_file=self.path)
+        for i in range(3):
+            pusher.submit('A', 1700000000 + i, main.LoRaTHSensor.layout, (20., 40., 3000))
+        pusher.spool_staged()
+        self.assertEqual((pusher.staged, pusher.queued), (0, 3))
+        pusher.spool.db.close()
+        spool = main.SubmissionSpool(self.path)
+        self.assertEqual(spool.pending_by_sensor(), {'A': 3})
+        spool.close()
+
+    def test_unusable_reply_does_not_keep_other_uploads_unacknowledged(self):
+        pusher = main.CloudEndpoint('http://127.0.0.1:9', '', spool_file=self.path)
+        for sensor_id in 'ABC':
+            pusher.submit(sensor_id, 1700000000, main.LoRaTHSensor.layout, (20., 40., 3000))
+        pusher.upload = lambda sensor_id, buffers: {'sensor-id': sensor_id}
+
+        def apply(sensor_id, info):
+            if sensor_id == 'A':
+                raise KeyError('report-interval')
+        main.config_sync.apply = apply
+        try:
+            with main.concurrent.futures.ThreadPoolExecutor(2) as executor:
+                pusher.push_cycle(executor)
+        finally:
+            del main.config_sync.apply
+        self.assertEqual(pusher.spool.pending_by_sensor(), {})
+        self.assertEqual((pusher.queued, pusher.pushed), (0, 3))
+        self.assertFalse(pusher.endpoint_breaker.open)
+        pusher.spool.close()
+
+    def test_legacy_rows_are_read(self):
+        spool = main.SubmissionSpool(self.path)
+        records = [[1700000000, {'temperature': 20.5, 'humidity': 40.0, 'battery': 3000}]]
+        spool.db.execute("INSERT INTO batches (sensor_id, size, records) VALUES ('A', 1, ?)", (json.dumps(records),))
+        spool.db.commit()
+        ids, buffers = spool.fetch('A', 100)
+        self.assertEqual(json.loads(main.CloudEndpoint.format_records(buffers)),
+                         [{'timestamp': 1700000000, 'value': records[0][1]}])
+        spool.close()
+
+    def test_fetch_limit_and_trim(self):
+        spool = main.SubmissionSpool(self.path)
+        for _ in range(4):
+            spool.append([('A', self.buffer(3))])
+        ids, buffers = spool.fetch('A', 7)
+        self.assertEqual(sum(map(len, buffers)), 6)
+        self.assertEqual(spool.trim(6), (12, 6))
+        self.assertEqual(spool.pending(), 6)
+        spool.close()
+
+
+class ReadingHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.history = main.ReadingHistory(self.directory.name, capacity=8)
+
+    def tearDown(self):
+        self.history.close()
+        self.directory.cleanup()
+
+    def test_ring_keeps_the_last_capacity_readings_across_reopen(self):
+        for i in range(12):
+            self.history.append('A', 1000 + i * 10, 20. + i, 40., 0., 3000, 180, 10)
+        self.history.close()
+        self.history = main.ReadingHistory(self.directory.name, capacity=8)
+        readings = self.history.query('A', {'latest': ['100']})
+        self.assertEqual([reading['timestamp'] for reading in readings], [1000 + i * 10 for i in range(4, 12)])
+        readings = self.history.query('A', {'start': ['1050'], 'end': ['1100']})
+        self.assertEqual([reading['timestamp'] for reading in readings], [1050, 1060, 1070, 1080, 1090])
+
+    def test_downsample(self):
+        for i in range(6):
+            self.history.append('A', 1000 + i * 10, 20. + i, 40., 0., 3000 + i, 180, 10)
+        rows = self.history.query('A', {'start': ['1000'], 'end': ['1060'], 'step': ['30']})
+        self.assertEqual([(row['timestamp'], row['temperature'], row['battery']) for row in rows],
+                         [(1000., 21., 3002), (1030., 24., 3005)])
+
+    def test_invalid_parameters(self):
+        self.history.append('A', 1000, 20., 40., 0., 3000, 180, 10)
+        for params in ({'step': ['0']}, {'step': ['-60']}, {'step': ['nan']}, {'latest': ['-1']}):
+            with self.assertRaises(ValueError):
+                self.history.query('A', params)
+        self.assertIsNone(self.history.query('B', {}))
+
+
+class FrameDeduplicatorTest(unittest.TestCase):
+    def test_repeats_within_the_window(self):
+        deduplicator = main.FrameDeduplicator(window=2.)
+        payload = ('A', 20., 40., 0., 3000, 1)
+        self.assertFalse(deduplicator.seen(payload, 100))
+        self.assertTrue(deduplicator.seen(payload, 101))
+        self.assertFalse(deduplicator.seen(payload, 103.5))
+        # A copy heard by another radio is a duplicate too
+        self.assertTrue(deduplicator.seen(payload, 104, source=1))
+
+    def test_motion_events_repeat_on_one_radio(self):
+        deduplicator = main.FrameDeduplicator(window=2.)
+        motion = ('A', 20., 40., -1., 3000, 1)
+        self.assertFalse(deduplicator.seen(motion, 100, 0, True))
+        self.assertTrue(deduplicator.seen(motion, 100, 1, True))
+        # A retransmission on the same radio is a duplicate, a new event a second later is not
+        self.assertTrue(deduplicator.seen(motion, 100.2, 0, True))
+        self.assertFalse(deduplicator.seen(motion, 101, 0, True))
+
+    def test_repeated_motion_events_are_all_counted(self):
+        line = frame_line(extension=-1.)
+        fields = main.decode_frames(main.decode_hex_lines([line]))[0]
+        sensor = main.LoRaTHOSensor(fields[3], 'O', 60, None)
+        sensors, deduplicator = dict(main.sensors), main.deduplicator
+        main.sensors[fields[3]] = sensor
+        main.discovery.confirmed.add(fields[3])
+        main.deduplicator = main.FrameDeduplicator(window=2.)
+        try:
+            buffer = main.decode_hex_lines([line])
+            main.handle_frame_buffer(buffer, 1000, source=0)
+            main.handle_frame_buffer(buffer, 1000, source=1)
+            main.handle_frame_buffer(buffer, 1001, source=0)
+            main.handle_frame_buffer(buffer, 1001, source=0)
+        finally:
+            main.sensors.clear()
+            main.sensors.update(sensors)
+            main.deduplicator = deduplicator
+            main.discovery.confirmed.discard(fields[3])
+        self.assertEqual(sensor.motion_event, 2)
+
+
+class CarryOverTest(unittest.TestCase):
+    def test_window_moves_to_the_replacement_once(self):
+        submitted = list()
+
+        class Handler:
+            def submit(self, sensor_id, timestamp, layout, values):
+                submitted.append((sensor_id, timestamp, values))
+
+        aggregation = main.aggregation
+        main.aggregation = 'window'
+        try:
+            previous = main.LoRaTHOSensor('A', 'O', 60, Handler())
+            previous.receive(1000, 180, 10, 190, 'A', 20., 40., -1., 3000, 0)
+            sensor = main.LoRaTHOSensor('A', 'O', 60, Handler(), slot=previous.slot)
+            sensor.carry_over(previous)
+            # The replaced sensor, still held by another thread, has nothing left to submit
+            previous.close_window(float('inf'))
+            sensor.close_window(float('inf'))
+        finally:
+            main.aggregation = aggregation
+        self.assertEqual(len(submitted), 1)
+        self.assertEqual(submitted[0][2][6], 1)
+        self.assertEqual(previous.motion_event, 0)
+
+
+class FrameRingTest(unittest.TestCase):
+    def ring(self, capacity=4):
+        return main.FrameRing(bytearray(main.FrameRing.size(capacity)), capacity)
+
+    def test_frames_wrap_and_drop_when_full(self):
+        ring = self.ring()
+        for i in range(6):
+            ring.write(float(i), 1700000000 + i, 1, bytes([i]) * 30)
+        self.assertEqual(ring.dropped, 2)
+        self.assertEqual([frame[0] for frame in ring.read(3)], [0., 1., 2.])
+        for i in range(6, 9):
+            ring.write(float(i), 1700000000 + i, 1, bytes([i]) * 30)
+        self.assertEqual([(frame[0], frame[3][0]) for frame in ring.read(10)], [(3., 3), (6., 6), (7., 7), (8., 8)])
+
+    def test_uncommitted_slot_is_not_read(self):
+        ring = self.ring()
+        ring.write(0., 1700000000, 0, bytes(30))
+        # The write index of the next frame became visible before its slot
+        ring.index.pack_into(ring.buffer, 0, 2)
+        self.assertEqual(len(ring.read(10)), 1)
+        self.assertEqual(ring.read(10), [])
+        # Once committed, the slot is read
+        ring.slot.pack_into(ring.buffer, ring.slots_offset + ring.slot_size, 1., 1700000001, 0, bytes(30))
+        ring.index.pack_into(ring.buffer, ring.slots_offset + ring.slot_size + ring.slot.size, 2)
+        self.assertEqual([frame[0] for frame in ring.read(10)], [1.])
+
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'capture.bin')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_legacy(self, records):
+        with open(self.path, 'wb') as fp:
+            for kind, timestamp, data in records:
+                fp.write(main.struct.pack('<BdI', kind, timestamp, len(data)) + data)
+
+    def test_round_trip(self):
+        writer = main.CaptureWriter(self.path)
+        writer.write(main.CaptureWriter.CHUNK, 100., b'abc', source=2)
+        writer.write(main.CaptureWriter.FRAME, 101., b'de')
+        writer.close()
+        self.assertEqual(list(main.read_capture(self.path)), [(0, 2, 100., b'abc'), (1, 0, 101., b'de')])
+
+    def test_captures_without_a_version_are_read(self):
+        self.write_legacy([(main.CaptureWriter.CHUNK, 100., b'abc'), (main.CaptureWriter.FRAME, 101., b'de')])
+        self.assertEqual(list(main.read_capture(self.path)), [(0, 0, 100., b'abc'), (1, 0, 101., b'de')])
+
+    def test_old_capture_is_rotated_not_appended_to(self):
+        self.write_legacy([(main.CaptureWriter.CHUNK, 100., b'abc')])
+        writer = main.CaptureWriter(self.path)
+        writer.write(main.CaptureWriter.CHUNK, 102., b'xyz', source=1)
+        writer.close()
+        self.assertEqual(main.capture_files(self.path), [self.path + '.1', self.path])
+        self.assertEqual([record for path in main.capture_files(self.path) for record in main.read_capture(path)],
+                         [(0, 0, 100., b'abc'), (0, 1, 102., b'xyz')])
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_max_failures_and_closes_on_success(self):
+        breaker = main.CircuitBreaker(max_failures=2, base_delay=10.)
+        breaker.failure(0.)
+        self.assertTrue(breaker.allow(0.))
+        breaker.failure(0.)
+        self.assertTrue(breaker.open)
+        self.assertFalse(breaker.allow(4.))
+        self.assertTrue(breaker.allow(10.))
+        breaker.success()
+        self.assertFalse(breaker.open)
+        self.assertTrue(breaker.allow(0.))
+
+
+if __name__ == '__main__':
+    unittest.main()